@@ -0,0 +1,184 @@
+"""
+Asyncio webhook receiver.
+
+Serves the same webhook routes as the Flask app on an aiohttp event loop,
+so one process can hold thousands of concurrent mailgun connections during
+a send burst.  Bodies are read and parsed on the loop; replay checks,
+verification and the lead updates go through the Flask app's handlers on a
+bounded thread pool of ASYNC_DB_THREADS threads, each with its own
+scoped session.
+
+    python aioreceiver.py --host 0.0.0.0 --port 5001
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from aiohttp import web
+from kombu.exceptions import OperationalError
+from sqlalchemy import exc
+from app import (handle_event, shed_event, spool_replayer, batch_counts, screen_batch, process_batch,
+                 batch_error, batch_result)
+import argparse
+import asyncio
+import backpressure
+import spool
+import database
+import metrics
+import webhooks
+import config
+import time
+
+# keep SQLALCHEMY_POOL_SIZE + SQLALCHEMY_MAX_OVERFLOW at least this large
+executor = ThreadPoolExecutor(max_workers=config.ASYNC_DB_THREADS)
+
+
+def _in_thread(func, *args):
+    try:
+        return func(*args)
+    finally:
+        database.db_session.remove()
+
+
+async def run_blocking(func, *args):
+    """
+    Run a blocking handler on the db thread pool
+    :param func:
+    :param args:
+    :return: func's result
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, partial(_in_thread, func, *args))
+
+
+def handle_batch(batch, counts):
+    """
+    Screen and apply one batch of JSON events, in a pool thread.  Errors are
+    answered here so the rollback runs on the thread owning the session.
+    :param batch: (kind, event) pairs
+    :param counts: dict from batch_counts(), updated
+    :return: (body, status) on error, else None
+    """
+    verified = []
+    try:
+        verified = screen_batch(batch, counts)
+        process_batch(verified, counts)
+    except (ValueError, OperationalError, exc.SQLAlchemyError, spool.CircuitOpenError, OSError) as err:
+        return batch_error(err, verified, counts)
+    return None
+
+
+async def form_webhook(request, kind=None):
+    start = time.perf_counter()
+    form = await request.post()
+
+    if kind is None:
+        kind = webhooks.EVENT_KINDS.get(form.get('event'))
+
+        # return 400: unknown or missing event type
+        if kind is None:
+            metrics.webhook_done('unknown', 400, start)
+            return web.json_response({"Error": "Unknown event type..."}, status=400)
+
+    reason = backpressure.admit(kind)
+    if reason:
+        body, status, headers = shed_event(kind, reason, start)
+        return web.json_response(body, status=status, headers=headers)
+
+    try:
+        event = webhooks.EVENT_TYPES[kind].extract(form)
+        metrics.stage_done('parse', kind, start)
+        body, status = await run_blocking(handle_event, kind, event)
+    finally:
+        backpressure.release(kind)
+
+    metrics.webhook_done(kind, status, start)
+    return web.json_response(body, status=status)
+
+
+async def json_webhook(request, kind=None):
+    start = time.perf_counter()
+    counts = batch_counts()
+    decoder = webhooks.JSONStreamDecoder()
+    size = config.WEBHOOK_BATCH_SIZE
+    batch = []
+    done = False
+
+    while not done:
+        try:
+            chunk = await request.content.read(65536)
+            done = not chunk
+            payloads = decoder.close() if done else decoder.feed(chunk)
+            batch.extend(webhooks.event_from_json(payload, kind) for payload in payloads)
+
+        # malformed body
+        except ValueError as err:
+            body, status = batch_error(err, [], counts)
+            metrics.batch_done(counts, status, start)
+            return web.json_response(body, status=status)
+
+        # hand full batches to the pool, the rest once the body is read
+        while len(batch) >= size or (done and batch):
+            failed = await run_blocking(handle_batch, batch[:size], counts)
+            if failed:
+                metrics.batch_done(counts, failed[1], start)
+                return web.json_response(failed[0], status=failed[1])
+            del batch[:size]
+
+    body, status = batch_result(counts)
+    metrics.batch_done(counts, status, start)
+    return web.json_response(body, status=status)
+
+
+async def json_webhook_shed(request, kind=None):
+    start = time.perf_counter()
+    reason = backpressure.admit(kind)
+    if reason:
+        body, status, headers = shed_event(kind, reason, start, 'batch')
+        return web.json_response(body, status=status, headers=headers)
+
+    try:
+        return await json_webhook(request, kind)
+    finally:
+        backpressure.release(kind)
+
+
+def webhook_handler(kind):
+    async def handler(request):
+        # mailgun JSON webhooks, single or batched
+        if request.content_type in webhooks.JSON_MIMETYPES:
+            return await json_webhook_shed(request, kind)
+        return await form_webhook(request, kind)
+    return handler
+
+
+async def prometheus_metrics(request):
+    text = await run_blocking(metrics.registry.render)
+    return web.Response(text=text, content_type='text/plain')
+
+
+def create_app():
+    """
+    The aiohttp application with every mailgun webhook route and /metrics
+    :return: web.Application
+    """
+    application = web.Application()
+    for rule, kind in webhooks.WEBHOOK_ROUTES:
+        application.router.add_post(rule, webhook_handler(kind))
+    application.router.add_get('/metrics', prometheus_metrics)
+
+    # drain whatever an earlier process left in the spool
+    if spool_replayer is not None:
+        spool_replayer.start()
+    return application
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
+
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
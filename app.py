@@ -1,78 +1,216 @@
-from flask import Flask, Response, abort, request, jsonify, g, url_for, render_template, flash
-from flask_mail import Mail, Message
+import startup
+from flask import Blueprint, Flask, Response, abort, request, jsonify, g, render_template, flash, \
+    stream_with_context
 from flask_sslify import SSLify
-from flask_sqlalchemy import SQLAlchemy
 from flask_httpauth import HTTPBasicAuth
-from sqlalchemy import exc, and_, desc
+from sqlalchemy import exc
 from database import db_session
-from celery import Celery
+from kombu.exceptions import OperationalError
 from datetime import datetime
-from models import User, Lead, Company
+from models import User
+from tasks import celery, queue_emails, apply_webhook_event, apply_webhook_events
+import webhooks
+import backpressure
+import leads
+import database
+import replay
+import spool
+import tenants
+import verification
+import rollups
+import metrics
+import mailer
+import leadimport
+import leadexport
+import livestream
 import config
 import json
-import hashlib
-import hmac
+import logging
+import time
 
 # debug
 debug = config.DEBUG
 
-# app config
-app = Flask(__name__)
-sslify = SSLify(app)
-app.config['SECRET_KEY'] = config.SECRET_KEY
+logger = logging.getLogger(__name__)
 
-# Flask-Mail configuration
-app.config['MAIL_SERVER'] = 'smtp.mail-server.com'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
-app.config['MAIL_USERNAME'] = config.MAIL_USERNAME
-app.config['MAIL_PASSWORD'] = config.MAIL_PASSWORD
-app.config['MAIL_DEFAULT_SENDER'] = config.MAIL_DEFAULT_SENDER
+# the web routes, registered on the app by create_app()
+views = Blueprint('views', __name__)
 
-# SQLAlchemy
-app.config['SQLALCHEMY_DATABASE_URI'] = config.SQLALCHEMY_DATABASE_URI
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = config.SQLALCHEMY_TRACK_MODIFICATIONS
-db = SQLAlchemy(app)
+# auth
+auth = HTTPBasicAuth()
 
-# disable strict slashes
-app.url_map.strict_slashes = False
+# webhook signature verification, every active signing key is prepared once
+verifier = verification.SignatureVerifier(
+    config.MAILGUN_SIGNING_KEYS,
+    max_age=config.WEBHOOK_MAX_AGE
+)
+
+
+def load_company_keys(cache):
+    # company signing keys arrive with every tenant mapping load
+    verifier.replace_company_keys(dict(
+        (company_id, [key]) for company_id, key in cache.signing_keys.items()
+    ))
+
+
+tenants.tenant_cache.on_load(load_company_keys)
+
+# webhook ingest mode, 'sync' or 'queue'
+ingest_mode = config.WEBHOOK_INGEST_MODE
+
+# duplicate and retried webhook filter
+replay_cache = replay.create_replay_cache(
+    config.REPLAY_CACHE,
+    config.REPLAY_WINDOW,
+    max_entries=config.REPLAY_MAX_ENTRIES,
+    redis_url=config.REPLAY_REDIS_URL
+)
+
+# database circuit breaker, tripped events go to the local spool
+db_breaker = spool.CircuitBreaker(config.DB_BREAKER_FAILURES, config.DB_BREAKER_RESET)
+event_spool = spool.create_spool(config.WEBHOOK_SPOOL_DIR, config.SPOOL_SEGMENT_BYTES)
+spool_replayer = None
+if event_spool is not None:
+    spool_replayer = spool.SpoolReplayer(
+        event_spool,
+        db_breaker,
+        db_session,
+        webhooks.apply_events,
+        batch_size=config.SPOOL_REPLAY_BATCH,
+        interval=config.SPOOL_REPLAY_INTERVAL
+    )
 
-# Celery config
-app.config['CELERY_BROKER_URL'] = config.CELERY_BROKER_URL
-app.config['CELERY_RESULT_BACKEND'] = config.CELERY_RESULT_BACKEND
-app.config['CELERY_ACCEPT_CONTENT'] = config.CELERY_ACCEPT_CONTENT
-app.config.update(accept_content=['json', 'pickle'])
 
-# Initialize Celery
-celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
-celery.conf.update(app.config)
+def pool_gauge(stat):
+    return lambda: database.pool_stats().get(stat)
 
-# Config mail
-mail = Mail(app)
 
-# auth
-auth = HTTPBasicAuth()
+def shed_inflight():
+    if backpressure.shedder is None:
+        return None
+    return dict(((name,), count) for name, count in backpressure.shedder.inflight.items())
 
-# mailgun_api_key
-mailgun_api_key = config.MAILGUN_API_KEY
 
+def shed_latency():
+    if backpressure.shedder is None:
+        return None
+    return backpressure.shedder.latency
 
-# clear all db sessions at the end of each request
-@app.teardown_appcontext
-def shutdown_session(exception=None):
-    db.session.remove()
+
+def spool_stats():
+    if event_spool is None:
+        return None
+    return {
+        ("appended",): event_spool.appended,
+        ("replayed",): spool_replayer.replayed,
+        ("segments",): len(event_spool.segments())
+    }
+
+
+def cache_stats():
+    return dict(
+        ((name, stat), value)
+        for name, cache in (('lead', leads.lead_cache), ('message', leads.message_cache))
+        for stat, value in cache.stats().items()
+    )
 
 
-# tasks sections, for async functions, etc...
-@celery.task(serializer='pickle')
-def send_async_email(msg):
-    """Background task to send an email with Flask-Mail."""
-    with app.app_context():
-        mail.send(msg)
+def celery_queue_lengths():
+    """
+    Messages waiting on the celery queues, read from the broker at scrape
+    time.  The redis transport has no queue while it is empty and refuses
+    the passive declare, that counts as 0.
+    :return: {(queue,): length}
+    """
+    lengths = {}
+    with celery.connection_for_write() as connection:
+        connection.ensure_connection(max_retries=1)
+        for queue in sorted(set((config.WEBHOOK_QUEUE, 'celery'))):
+            # a refused declare closes the channel on amqp, one per queue
+            with connection.channel() as channel:
+                try:
+                    lengths[(queue,)] = channel.queue_declare(queue=queue, passive=True).message_count
+                except connection.channel_errors:
+                    lengths[(queue,)] = 0
+    return lengths
+
+
+# gauges for /metrics, all read at scrape time
+for pool_stat, description in (
+        ('size', 'Connection pool size'),
+        ('checked_out', 'Connections in use'),
+        ('checked_in', 'Idle connections in the pool'),
+        ('overflow', 'Connections open beyond the pool size'),
+        ('checkouts', 'Connection checkouts since start'),
+        ('timeouts', 'Connection checkouts that timed out since start'),
+        ('wait_total', 'Seconds spent waiting for a connection since start'),
+        ('wait_max', 'Longest wait for a connection in seconds')):
+    metrics.registry.gauge('db_pool_' + pool_stat, description, pool_gauge(pool_stat))
+
+metrics.registry.gauge(
+    'celery_queue_length',
+    'Messages waiting on the celery broker',
+    celery_queue_lengths,
+    ('queue',)
+)
+metrics.registry.gauge(
+    'webhook_inflight',
+    'Webhooks being handled, by load shedding class',
+    shed_inflight,
+    ('class',)
+)
+metrics.registry.gauge(
+    'webhook_commit_latency_seconds',
+    'Moving average of the webhook commit latency the load shedder acts on',
+    shed_latency
+)
+metrics.registry.gauge(
+    'db_breaker_open',
+    'Whether the database circuit breaker is open (1) or half open (0.5)',
+    lambda: {'closed': 0, 'half-open': 0.5, 'open': 1}[db_breaker.state]
+)
+metrics.registry.gauge(
+    'webhook_spool',
+    'Webhook events appended to and replayed from the local spool, and its segment files',
+    spool_stats,
+    ('stat',)
+)
+metrics.registry.gauge(
+    'webhook_lead_cache',
+    'Lead and Message-Id lookup cache hits, misses, size and maxsize since start',
+    cache_stats,
+    ('cache', 'stat')
+)
+metrics.registry.gauge(
+    'process_start_time_seconds',
+    'Start time of the process since unix epoch in seconds',
+    lambda: startup.started
+)
+metrics.registry.gauge(
+    'startup_seconds',
+    'Seconds from process start to the end of each startup phase',
+    lambda: dict(((phase,), elapsed) for phase, elapsed in startup.phases.items()),
+    ('phase',)
+)
+
+
+@auth.verify_password
+def verify_password(username, password):
+    user = db_session.query(User).filter(User.username == username).first()
+    if not user or not user.check_password(password):
+        return False
+    g.user = user
+    return True
+
+
+# clear all db sessions at the end of each request
+@views.teardown_app_request
+def shutdown_session(exception=None):
+    db_session.remove()
 
 
 # default routes
-@app.route('/', methods=['GET'])
+@views.route('/', methods=['GET'])
 def site_root():
     """
     Send a nice welcome API homepage
@@ -90,15 +228,16 @@ def site_root():
     )
 
 
-@app.route('/api', methods=['GET'])
-@app.route('/api/v1', methods=['GET'])
-@app.route('/api/v1/index', methods=['GET'])
+@views.route('/api', methods=['GET'])
+@views.route('/api/v1', methods=['GET'])
+@views.route('/api/v1/index', methods=['GET'])
 def index():
     """
     The default API view.  List all webhook routes:
     :return: dict
     """
     api_routes = {}
+    api_routes['events'] = '/api/v1/wh/mg/events'
     api_routes['delivered'] = '/api/v1/wh/mg/lead/email/delivered'
     api_routes['dropped'] = '/api/v1/wh/mg/lead/email/dropped'
     api_routes['hard-bounce'] = '/api/v1/wh/mg/lead/email/bounced'
@@ -106,583 +245,274 @@ def index():
     api_routes['unsubscribe'] = '/api/v1/wh/mg/lead/email/unsubscribe'
     api_routes['clicks'] = '/api/v1/wh/mg/lead/email/click'
     api_routes['opens'] = '/api/v1/wh/mg/lead/email/open'
+    api_routes['stats'] = '/api/v1/stats/<company_id>'
+    api_routes['stats-hourly'] = '/api/v1/stats/<company_id>/hourly'
+    api_routes['stats-campaigns'] = '/api/v1/stats/<company_id>/campaigns'
+    api_routes['live'] = '/api/v1/live/<company_id>'
 
     # return the response
     return jsonify(api_routes), 200
 
 
-@app.route('/api/v1/wh/mg/lead/email/delivered', methods=['POST'])
-def lead_email_delivered():
+def mailgun_webhook(kind=None):
     """
-    The lead email delivered webhook.
+    The mailgun webhook.  The events route dispatches on the form's event
+    field, the per event routes are kept as aliases with a fixed kind, see
+    webhooks.WEBHOOK_ROUTES.
+    :param kind: the event kind, see webhooks.EVENT_SPECS
     :return: json
     """
-    if request.method == 'POST':
-
-        form_data = {
-            "message_id": request.form.get('Message-Id', None),
-            "x_mail_gun_sid": request.form.get('X-Mailgun-Sid', None),
-            "domain": request.form.get('domain', 'email.com'),
-            "event": request.form.get('event', 'delivered'),
-            "timestamp": request.form.get('timestamp', None),
-            "recipient": request.form.get('recipient', None),
-            "signature": request.form.get('signature', None),
-            "token": request.form.get('token', None)
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        event = form_data['event']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-                lead = db_session.query(Lead).filter(
-                    Lead.email_addr == mg_recipient
-                ).first()
-
-                if lead:
-
-                    email = lead.email
-                    lead_id = lead.id
-                    event = form_data['event']
-
-                    # set the delivered flags in the database
-                    lead.followup_email_delivered = 1
-                    lead.followup_email_status = event
-                    lead.webhook_last_updated = datetime.now()
-                    db_session.commit()
-
-                    # return a successful response
-                    return jsonify({
-                        "l_id": lead_id,
-                        "email": email,
-                        "event": event,
-                        "status": 'success'}), 202
-
-                # return 404: no email for recipient email address
-                else:
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=404, mimetype='application/json')
-
-            # database exception
-            except exc.SQLAlchemyError as db_err:
-                resp = {"Database Error": str(db_err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
-
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+    # mailgun JSON webhooks, single or batched
+    if request.mimetype in webhooks.JSON_MIMETYPES:
+        return mailgun_webhook_json(kind)
 
-    # method not allowed
-    else:
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+    start = time.perf_counter()
+    if kind is None:
+        kind = webhooks.EVENT_KINDS.get(request.form.get('event'))
+
+        # return 400: unknown or missing event type
+        if kind is None:
+            metrics.webhook_done('unknown', 400, start)
+            return json_response({"Error": "Unknown event type..."}, 400)
+
+    reason = backpressure.admit(kind)
+    if reason:
+        return shed_response(kind, reason, start)
+
+    try:
+        event = webhooks.EVENT_TYPES[kind].extract(request.form)
+        metrics.stage_done('parse', kind, start)
+        body, status = handle_event(kind, event)
+    finally:
+        backpressure.release(kind)
 
+    metrics.webhook_done(kind, status, start)
+    return json_response(body, status)
 
-@app.route('/api/v1/wh/mg/lead/email/dropped', methods=['POST'])
-def lead_email_dropped():
+
+def mailgun_webhook_json(kind=None):
     """
-    The lead email dropped webhook
+    Mailgun JSON webhooks.  The body is one event, a JSON array of events or
+    newline delimited events, and is parsed as a stream.  Events are taken in
+    batches of WEBHOOK_BATCH_SIZE, each batch is verified in one pass and
+    applied in one transaction.
+    :param kind: force the event kind, eg. from a per event route
     :return: json
     """
-    if request.method == 'POST':
-
-        form_data = {
-            "message_id": request.form.get('Message-Id', None),
-            "x_mail_gun_sid": request.form.get('X-Mailgun-Sid', None),
-            "domain": request.form.get('domain', 'email.com'),
-            "event": request.form.get('event', 'dropped'),
-            "timestamp": request.form.get('timestamp', None),
-            "recipient": request.form.get('recipient', None),
-            "signature": request.form.get('signature', None),
-            "token": request.form.get('token', None),
-            "reason": request.form.get('reason', None),
-            "code": request.form.get('code', None),
-            "description": request.form.get('description', None)
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        event = form_data['event']
-        reason = form_data['reason']
-        code = form_data['code']
-        description = form_data['description']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-
-                lead = db_session.query(Lead).filter(
-                    Lead.email_addr == mg_recipient
-                ).one()
-
-                if lead:
-                    email = lead.email
-                    lead_id = lead.id
-                    event = form_data['event']
-
-                    # set the dropped flags in the database
-                    lead.followup_email_delivered = 0
-                    lead.followup_email_status = event
-                    lead.followup_email_dropped = 1
-                    lead.dropped_code = code
-                    lead.dropped_reason = reason
-                    lead.dropped_description = description
-                    lead.webhook_last_updated = datetime.now()
-                    db_session.commit()
-
-                    # return a successful response
-                    return jsonify({
-                        "l_id": lead_id,
-                        "email": email,
-                        "event": event,
-                        "status": 'success'}), 202
-
-                # return 404 for lead not found
-                else:
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=404, mimetype='application/json')
-
-            # database exception
-            except exc.SQLAlchemyError as err:
-                resp = {"Database Error": str(err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
-
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+    start = time.perf_counter()
+    reason = backpressure.admit(kind)
+    if reason:
+        return shed_response(kind, reason, start, 'batch')
+
+    counts = batch_counts()
+    events = webhooks.iter_json_events(request.stream, kind)
+    verified = []
+
+    try:
+        for batch in webhooks.batched(events, config.WEBHOOK_BATCH_SIZE):
+            verified = screen_batch(batch, counts)
+            process_batch(verified, counts)
+
+    except (ValueError, OperationalError, exc.SQLAlchemyError, spool.CircuitOpenError, OSError) as err:
+        body, status = batch_error(err, verified, counts)
 
-    # method not allowed
     else:
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+        body, status = batch_result(counts)
+
+    finally:
+        backpressure.release(kind)
 
+    metrics.batch_done(counts, status, start)
+    return json_response(body, status)
 
-@app.route('/api/v1/wh/mg/lead/email/bounced', methods=['POST'])
-def lead_email_bounced():
+
+for rule, route_kind in webhooks.WEBHOOK_ROUTES:
+    route_options = {"methods": ['POST']}
+    if route_kind is not None:
+        route_options['defaults'] = {'kind': route_kind}
+    views.add_url_rule(rule, 'mailgun_webhook', mailgun_webhook, **route_options)
+
+
+@views.route('/api/v1/stats/<int:company_id>', methods=['GET'])
+@auth.login_required
+def company_stats(company_id):
     """
-    The lead email bounced webhook
+    A company's engagement counts and rates over the last hours, read
+    from the rollup tables only
+    :param company_id:
     :return: json
     """
-    if request.method == 'POST':
-
-        form_data = {
-            "message_id": request.form.get('Message-Id', None),
-            "x_mail_gun_sid": request.form.get('X-Mailgun-Sid', None),
-            "domain": request.form.get('domain', 'email.com'),
-            "event": request.form.get('event', 'bounce'),
-            "timestamp": request.form.get('timestamp', None),
-            "recipient": request.form.get('recipient', None),
-            "signature": request.form.get('signature', None),
-            "token": request.form.get('token', None),
-            "code": request.form.get('code', None),
-            "error": request.form.get('error', None)
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        event = form_data['event']
-        code = form_data['code']
-        bounce_error = form_data['error']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-                lead = db_session.query(Lead).filter(
-                    Lead.email_addr == mg_recipient
-                ).one()
-
-                if lead:
-                    email = lead.email
-                    lead_id = lead.id
-                    event = form_data['event']
-
-                    # set the dropped flags in the database
-                    lead.followup_email_delivered = 0
-                    lead.followup_email_status = event
-                    lead.followup_email_bounced = 1
-                    lead.dropped_code = code
-                    lead.bounce_error = bounce_error
-                    lead.webhook_last_updated = datetime.now()
-                    db_session.commit()
-
-                    # return a successful response
-                    return jsonify({
-                        "l_id": lead_id,
-                        "email": email,
-                        "event": event,
-                        "status": 'success'}), 202
-
-                # return 404 for lead not found
-                else:
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=404, mimetype='application/json')
-
-            # database exception
-            except exc.SQLAlchemyError as err:
-                resp = {"Database Error": str(err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
-
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+    if g.user.company_id != company_id:
+        abort(403)
 
-    # method not allowed
-    else:
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+    hours = request.args.get('hours', 24, type=int)
+    stats = rollups.company_totals(db_session, company_id, hours=max(1, hours))
+    stats['company_id'] = company_id
+    return jsonify(stats), 200
 
 
-@app.route('/api/v1/wh/mg/lead/email/spam/complaint', methods=['POST'])
-def lead_email_spam_complaint():
+@views.route('/api/v1/stats/<int:company_id>/hourly', methods=['GET'])
+@auth.login_required
+def company_stats_hourly(company_id):
     """
-    The lead email spam complaint webhook
+    A company's engagement counts and rates hour by hour
+    :param company_id:
     :return: json
     """
-    if request.method == 'POST':
-
-        form_data = {
-            "message_id": request.form.get('Message-Id', None),
-            "x_mail_gun_sid": request.form.get('X-Mailgun-Sid', None),
-            "domain": request.form.get('domain', 'email.com'),
-            "event": request.form.get('event', 'spam-complaint'),
-            "timestamp": request.form.get('timestamp', None),
-            "recipient": request.form.get('recipient', None),
-            "signature": request.form.get('signature', None),
-            "token": request.form.get('token', None)
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        event = form_data['event']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-                lead = db_session.query(Lead).filter(
-                    Lead.email_addr == mg_recipient
-                ).one()
-
-                if lead:
-                    email = lead.email
-                    lead_id = lead.id
-                    event = form_data['event']
-
-                    # set the dropped flags in the database
-                    lead.followup_email_delivered = 0
-                    lead.followup_email_status = event
-                    lead.followup_email_spam = 1
-                    lead.webhook_last_updated = datetime.now()
-                    db_session.commit()
-
-                    # return a successful response
-                    return jsonify({
-                        "l_id": lead_id,
-                        "email": email,
-                        "event": event,
-                        "status": 'success'}), 202
-
-                # return 404 for lead not found
-                else:
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=404, mimetype='application/json')
-
-            # database exception
-            except exc.SQLAlchemyError as err:
-                resp = {"Database Error": str(err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
-
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+    if g.user.company_id != company_id:
+        abort(403)
 
-    # method not allowed
-    else:
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+    hours = request.args.get('hours', 24, type=int)
+    return jsonify({
+        "company_id": company_id,
+        "hours": rollups.company_hourly(db_session, company_id, hours=max(1, hours))}), 200
 
 
-@app.route('/api/v1/wh/mg/lead/email/unsubscribe', methods=['POST'])
-def lead_email_unsubscribe():
+@views.route('/api/v1/stats/<int:company_id>/campaigns', methods=['GET'])
+@auth.login_required
+def company_stats_campaigns(company_id):
     """
-    The lead email unsubscribe webhook
+    A company's engagement counts and rates per campaign
+    :param company_id:
     :return: json
     """
-    if request.method == 'POST':
-
-        form_data = {
-            "message_id": request.form.get('Message-Id', None),
-            "x_mail_gun_sid": request.form.get('X-Mailgun-Sid', None),
-            "domain": request.form.get('domain', 'email.com'),
-            "event": request.form.get('event', 'unsubscribe'),
-            "timestamp": request.form.get('timestamp', None),
-            "recipient": request.form.get('recipient', None),
-            "signature": request.form.get('signature', None),
-            "token": request.form.get('token', None)
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        event = form_data['event']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-                lead = db_session.query(Lead).filter(
-                    Lead.email_addr == mg_recipient
-                ).one()
-
-                if lead:
-                    email = lead.email
-                    lead_id = lead.id
-                    event = form_data['event']
-
-                    # set the dropped flags in the database
-                    lead.followup_email_delivered = 0
-                    lead.followup_email_status = event
-                    lead.followup_email_unsub = 1
-                    lead.webhook_last_updated = datetime.now()
-                    db_session.commit()
-
-                    # return a successful response
-                    return jsonify({
-                        "l_id": lead_id,
-                        "email": email,
-                        "event": event,
-                        "status": 'success'}), 202
-
-                # return 404 for lead not found
-                else:
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=404, mimetype='application/json')
-
-            # database exception
-            except exc.SQLAlchemyError as err:
-                resp = {"Database Error": str(err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
-
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+    if g.user.company_id != company_id:
+        abort(403)
 
-    # method not allowed
-    else:
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+    return jsonify({
+        "company_id": company_id,
+        "campaigns": rollups.company_campaigns(db_session, company_id)}), 200
 
 
-@app.route('/api/v1/wh/mg/lead/email/click', methods=['POST'])
-def lead_email_clicks():
+@views.route('/api/v1/companies/<int:company_id>/leads/import', methods=['POST'])
+@auth.login_required
+def import_company_leads(company_id):
     """
-    The lead email clicks webhook
-    :return: json
+    Stream a CSV (text/csv) or NDJSON (application/x-ndjson) lead list into
+    the company's leads, upserting on the email address.  The response is
+    NDJSON: a progress line after every chunk, then a summary line with
+    status 'done' or 'error'.
+    :param company_id:
+    :return: ndjson
     """
-    if request.method == 'POST':
-
-        form_data = {
-            "message_id": request.form.get('Message-Id', None),
-            "x_mail_gun_sid": request.form.get('X-Mailgun-Sid', None),
-            "domain": request.form.get('domain', None),
-            "event": request.form.get('event', 'click'),
-            "timestamp": request.form.get('timestamp', None),
-            "recipient": request.form.get('recipient', None),
-            "signature": request.form.get('signature', None),
-            "token": request.form.get('token', None),
-            "ip": request.form.get('ip', None),
-            "device_type": request.form.get('device-type', None),
-            "client_type": request.form.get('client-type', None)
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        event = form_data['event']
-        ip_addr = form_data['ip']
-        device_type = form_data['device_type']
-        client_type = form_data['client_type']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-                lead = db_session.query(Lead).filter(
-                    Lead.email_addr == mg_recipient
-                ).one()
-
-                if lead:
-                    email = lead.email
-                    lead_id = lead.id
-                    event = form_data['event']
-
-                    # set the dropped flags in the database
-                    lead.followup_email_delivered = 0
-                    lead.followup_email_status = event
-                    lead.followup_email_clicks += lead.followup_email_clicks
-                    lead.followup_email_click_ip = ip_addr
-                    lead.followup_email_click_device = device_type
-                    lead.webhook_last_updated = datetime.now()
-                    db_session.commit()
-
-                    # return a successful response
-                    return jsonify({
-                        "l_id": lead_id,
-                        "email": email,
-                        "event": event,
-                        "status": 'success'}), 202
-
-                # return 404 for lead not found
-                else:
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=404, mimetype='application/json')
-
-            # database exception
-            except exc.SQLAlchemyError as db_err:
-                resp = {"Database Error": str(db_err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
-
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+    if g.user.company_id != company_id:
+        abort(403)
 
-    # method not allowed
-    else:
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+    fmt = leadimport.IMPORT_FORMATS.get(request.mimetype)
+
+    # return 415: unsupported content type
+    if fmt is None:
+        return json_response({"Error": "Send text/csv or application/x-ndjson..."}, 415)
+
+    chunk_size = request.args.get('chunk_size', config.LEAD_IMPORT_CHUNK_SIZE, type=int)
+    rows = leadimport.iter_rows(request.stream, fmt)
+
+    def generate():
+        # progress lines go out as the chunks commit
+        stats = leadimport.import_stats()
+        try:
+            for stats in leadimport.iter_import(db_session, company_id, rows, chunk_size):
+                yield json.dumps(dict(stats, status='progress')) + '\n'
+            yield json.dumps(dict(stats, status='done')) + '\n'
 
+        except (ValueError, exc.SQLAlchemyError) as err:
+            yield json.dumps(dict(stats, status='error', error=str(err))) + '\n'
 
-@app.route('/api/v1/wh/mg/lead/email/open', methods=['POST'])
-def lead_email_opens():
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@views.route('/api/v1/companies/<int:company_id>/leads/export', methods=['GET'])
+@auth.login_required
+def export_company_leads(company_id):
+    """
+    Stream the company's leads with their webhook state, ?format=csv
+    (default) or ?format=ndjson
+    :param company_id:
+    :return: csv or ndjson
+    """
+    if g.user.company_id != company_id:
+        abort(403)
+
+    fmt = request.args.get('format', 'csv')
+
+    # return 400: unknown export format
+    if fmt not in leadexport.EXPORT_FORMATS:
+        return json_response({"Error": "Unknown export format..."}, 400)
+
+    return Response(
+        stream_with_context(leadexport.iter_export(db_session, company_id, fmt)),
+        mimetype=leadexport.EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": 'attachment; filename=leads-{}.{}'.format(company_id, fmt)}
+    )
+
+
+@views.route('/api/v1/live/<int:company_id>', methods=['GET'])
+@auth.login_required
+def live_stream(company_id):
+    """
+    Server-Sent Events stream of the company's webhook events as they are
+    applied ('webhook' events) and its per second counts ('counters',
+    every second), from the in memory live feed.  Reconnects to the same
+    process resume after the Last-Event-ID, others replay the buffer.
+    :param company_id:
+    :return: text/event-stream
     """
-    The lead email opens webhook
+    if g.user.company_id != company_id:
+        abort(403)
+
+    # return 404: live feed disabled
+    if webhooks.live_feed is None:
+        return json_response({"Error": "The live feed is disabled..."}, 404)
+
+    stream = livestream.iter_sse(
+        webhooks.live_feed,
+        company_id,
+        last_event_id=request.headers.get('Last-Event-ID'),
+        duration=config.LIVE_STREAM_MAX_SECONDS
+    )
+
+    return Response(
+        stream_with_context(stream),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": 'no-cache', "X-Accel-Buffering": 'no'}
+    )
+
+
+@views.route('/live', methods=['GET'])
+@auth.login_required
+def live_dashboard():
+    """
+    Live engagement dashboard for the user's company
+    :return: template
+    """
+    return render_template(
+        'live.html',
+        company_id=g.user.company_id,
+        today=get_date()
+    )
+
+
+@views.route('/api/v1/status/pool', methods=['GET'])
+@auth.login_required
+def pool_status():
+    """
+    Database connection pool gauges for this worker process
     :return: json
     """
-    if request.method == 'POST':
-
-        form_data = {
-            "message_id": request.form.get('Message-Id', None),
-            "x_mail_gun_sid": request.form.get('X-Mailgun-Sid', None),
-            "domain": request.form.get('domain', None),
-            "event": request.form.get('event', 'open'),
-            "timestamp": request.form.get('timestamp', None),
-            "recipient": request.form.get('recipient', None),
-            "signature": request.form.get('signature', None),
-            "token": request.form.get('token', None),
-            "ip": request.form.get('ip', None),
-            "device_type": request.form.get('device-type', None),
-            "client_type": request.form.get('client-type', None)
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        event = form_data['event']
-        ip_addr = form_data['ip']
-        device_type = form_data['device_type']
-        client_type = form_data['client_type']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-                lead = db_session.query(Lead).filter(
-                    Lead.email_addr == mg_recipient
-                ).one()
-
-                if lead:
-                    email = lead.email
-                    av_id = lead.appended_visitor_id
-                    event = form_data['event']
-
-                    # set the dropped flags in the database
-                    lead.followup_email_delivered = 0
-                    lead.followup_email_status = event
-                    lead.followup_email_opens += lead.followup_email_opens
-                    lead.followup_email_open_ip = ip_addr
-                    lead.followup_email_open_device = device_type
-                    lead.webhook_last_updated = datetime.now()
-                    db_session.commit()
-
-                    # return a successful response
-                    return jsonify({
-                        "v_id": av_id,
-                        "email": email,
-                        "event": event,
-                        "status": 'success'}), 202
-
-                else:
-                    # return 404: no email for recipient email address
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=404, mimetype='application/json')
-
-            # database exception
-            except exc.SQLAlchemyError as err:
-                resp = {"Database Error": str(err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
-
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+    return jsonify(database.pool_stats()), 200
 
-    else:
-        # method not allowed
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+
+@views.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Hot path latency histograms, outcome counters, pool and celery queue
+    gauges in the Prometheus text format.  Per process.
+    :return: text
+    """
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
 
 
-@app.route('/api/v1.0/auth/login', methods=['GET'])
+@views.route('/api/v1.0/auth/login', methods=['GET'])
 def login():
     """
     Template for Login page
@@ -698,12 +528,12 @@ def compare_(a, b):
     return a == b
 
 
-@app.errorhandler(404)
+@views.app_errorhandler(404)
 def page_not_found(err):
     return render_template('error-404.html'), 404
 
 
-@app.errorhandler(500)
+@views.app_errorhandler(500)
 def internal_server_error(err):
     return render_template('error-500.html'), 500
 
@@ -719,21 +549,434 @@ def flash_errors(form):
 
 def send_email(to, subject, msg_body, **kwargs):
     """
-    Send Mail function
+    Send Mail function, queues a JSON payload for send_email_batch
     :param to:
     :param subject:
     :param msg_body
-    :param kwargs:
-    :return: celery async task id
+    :param kwargs: extra payload fields, eg. text; lead_id and company_id
+                   log the message in the send log, company_id also
+                   checks the company suppression list
+    :return: celery async result, None when the address is suppressed
     """
-    msg = Message(
-        subject,
-        sender=app.config['MAIL_DEFAULT_SENDER'],
-        recipients=[to, ]
+    queued = queue_emails([mailer.email_payload(to, subject, msg_body, **kwargs)])
+    return queued[0] if queued else None
+
+
+def json_response(body, status):
+    return Response(json.dumps(body), status=status, mimetype='application/json')
+
+
+def shed_event(kind, reason, start, label=None):
+    """
+    Answer a webhook turned away by the load shedder
+    :param kind: the event kind, None for JSON bodies of mixed events
+    :param reason: from backpressure.admit()
+    :param start: time.perf_counter() when the request began
+    :param label: the metrics event label, defaults to kind
+    :return: (body, status, headers)
+    """
+    metrics.webhook_shed(label or kind, backpressure.event_class(kind), reason, start)
+    retry_after = str(config.WEBHOOK_SHED_RETRY_AFTER)
+    return {"Error": "Overloaded, retry later"}, 503, {"Retry-After": retry_after}
+
+
+def shed_response(kind, reason, start, label=None):
+    body, status, headers = shed_event(kind, reason, start, label)
+    response = json_response(body, status)
+    response.headers.extend(headers)
+    return response
+
+
+def handle_event(kind, event):
+    """
+    Screen and apply a single webhook event
+    :param kind: the event kind
+    :param event: dict from EventType.extract()
+    :return: (body, status)
+    """
+    return screen_event(kind, event) or process_event(kind, event)
+
+
+def screen_event(kind, event):
+    """
+    Everything a single webhook goes through before it is applied: the
+    replay checks, signature verification and claiming the event
+    :param kind: the event kind
+    :param event: dict from EventType.extract()
+    :return: (body, status) to answer with, or None to go on
+    """
+    # stale and duplicate webhooks never reach verify() or the database
+    start = time.perf_counter()
+    resolve_tenant(event)
+    replayed = replay_status(event)
+    start = metrics.stage_done('replay', kind, start)
+
+    # return 406: mailgun does not retry a rejected webhook
+    if replayed == 'stale':
+        return {"Error": "Stale webhook timestamp..."}, 406
+
+    if replayed == 'duplicate':
+        return {"event": event['event'], "status": 'duplicate'}, 200
+
+    # signature and token verification failed
+    valid = verify_event(event)
+    start = metrics.stage_done('verify', kind, start)
+    if not valid:
+        return {"Signature": event['signature'], "Token": event['token']}, 409
+
+    # claim the event, a concurrent copy may have won since the check above
+    claimed = claim_event(event)
+    metrics.stage_done('claim', kind, start)
+    if not claimed:
+        return {"event": event['event'], "status": 'duplicate'}, 200
+
+    return None
+
+
+def process_event(kind, event):
+    """
+    Apply a screened webhook event, or enqueue it in queue ingest mode
+    :param kind: the event kind
+    :param event: dict from EventType.extract()
+    :return: (body, status)
+    """
+    # accept and enqueue, the celery workers apply the lead update
+    if ingest_mode == 'queue':
+        start = time.perf_counter()
+        result = enqueue_event(kind, event)
+        metrics.stage_done('enqueue', kind, start)
+        return result
+
+    # database known to be down, do not wait on it
+    if must_spool():
+        return spool_event(kind, event)
+
+    try:
+        lead_id = webhooks.apply_event(db_session, kind, event)
+
+    # database unreachable, keep the event on local disk
+    except spool.UNAVAILABLE_ERRORS:
+        db_session.rollback()
+        db_breaker.failure()
+        logger.exception('applying a %s webhook failed', kind)
+        return spool_event(kind, event)
+
+    # database exception, the database answered so a half open breaker closes
+    except exc.SQLAlchemyError:
+        db_session.rollback()
+        db_breaker.success()
+        release_event(event)
+        logger.exception('applying a %s webhook failed', kind)
+        return {"Database Error": "Unable to apply the event"}, 500
+
+    db_breaker.success()
+
+    # return 404: no lead for recipient email address
+    if lead_id is None:
+        return {"Error": "Unable to resolve the recipient email address..."}, 404
+
+    # return a successful response
+    return {
+        "l_id": lead_id,
+        "email": event['recipient'],
+        "event": event['event'],
+        "status": 'success'}, 202
+
+
+def must_spool():
+    """
+    Whether webhook events go to the spool instead of the database: the
+    circuit breaker is open, or earlier events are still spooled
+    :return: bool
+    """
+    if event_spool is not None and event_spool.pending():
+        return True
+    return not db_breaker.allow()
+
+
+def spool_event(kind, event):
+    """
+    Append a verified event to the local spool, see spool.py
+    :param kind: the event kind
+    :param event: dict from EventType.extract()
+    :return: (body, status)
+    """
+    if event_spool is None:
+        release_event(event)
+        return {"Database Error": "Database unavailable"}, 503
+
+    start = time.perf_counter()
+    try:
+        event_spool.append([(kind, event)])
+    except OSError:
+        release_event(event)
+        logger.exception('spooling a %s webhook failed', kind)
+        return {"Database Error": "Database unavailable"}, 503
+    metrics.stage_done('spool', kind, start)
+    spool_replayer.start()
+
+    return {
+        "event": event['event'],
+        "status": 'spooled'}, 202
+
+
+def batch_counts():
+    return {
+        "accepted": 0,
+        "spooled": 0,
+        "not_found": 0,
+        "rejected": 0,
+        "ignored": 0,
+        "duplicate": 0,
+        "stale": 0
+    }
+
+
+def screen_batch(batch, counts):
+    """
+    Screen a batch of JSON webhook events: unknown, stale and duplicate
+    events are dropped before any HMAC work, the rest verified in one pass
+    and claimed
+    :param batch: (kind, event) pairs
+    :param counts: dict from batch_counts(), updated
+    :return: the verified (kind, event) pairs
+    """
+    candidates = []
+    for event_kind, event in batch:
+        resolve_tenant(event)
+        replayed = None if event_kind is None else replay_status(event)
+        if event_kind is None:
+            counts['ignored'] += 1
+        elif replayed:
+            counts[replayed] += 1
+        else:
+            candidates.append((event_kind, event))
+
+    # single verification pass over the batch
+    start = time.perf_counter()
+    signatures = verifier.verify_batch(
+        (event['token'], event['timestamp'], event['signature'], event['company_id'])
+        for _, event in candidates
     )
-    msg.body = ""
-    msg.html = msg_body
-    send_async_email.delay(msg)
+    metrics.stage_done('verify', 'batch', start)
+
+    verified = []
+    for (event_kind, event), valid in zip(candidates, signatures):
+        if not valid:
+            counts['rejected'] += 1
+        elif not claim_event(event):
+            counts['duplicate'] += 1
+        else:
+            verified.append((event_kind, event))
+
+    return verified
+
+
+def process_batch(verified, counts):
+    """
+    Apply a verified batch in one transaction, or enqueue it as one task
+    in queue ingest mode.  Broker and database errors are raised, see
+    batch_error().
+    :param verified: (kind, event) pairs from screen_batch()
+    :param counts: dict from batch_counts(), updated
+    :return: None
+    """
+    if not verified:
+        return
+
+    # accept and enqueue, the celery workers apply the batch
+    if ingest_mode == 'queue':
+        start = time.perf_counter()
+        apply_webhook_events.apply_async(
+            args=(verified,),
+            queue=config.WEBHOOK_QUEUE
+        )
+        metrics.stage_done('enqueue', 'batch', start)
+        counts['accepted'] += len(verified)
+        return
+
+    if must_spool():
+        spool_batch(verified, counts)
+        return
+
+    try:
+        lead_ids = webhooks.apply_events(db_session, verified)
+
+    # database unreachable, keep the batch on local disk
+    except spool.UNAVAILABLE_ERRORS:
+        db_session.rollback()
+        db_breaker.failure()
+        logger.exception('applying a webhook batch failed')
+        spool_batch(verified, counts)
+        return
+
+    # database exception, the database answered so a half open breaker closes
+    except exc.SQLAlchemyError:
+        db_breaker.success()
+        raise
+
+    db_breaker.success()
+    found = len([lead_id for lead_id in lead_ids if lead_id is not None])
+    counts['accepted'] += found
+    counts['not_found'] += len(lead_ids) - found
+
+
+def spool_batch(verified, counts):
+    """
+    Append a verified batch to the local spool.  Raises CircuitOpenError
+    without a spool and OSError when the append fails, see batch_error().
+    :param verified: (kind, event) pairs from screen_batch()
+    :param counts: dict from batch_counts(), updated
+    :return: None
+    """
+    if event_spool is None:
+        raise spool.CircuitOpenError('database circuit breaker is open')
+
+    start = time.perf_counter()
+    event_spool.append(verified)
+    metrics.stage_done('spool', 'batch', start)
+    spool_replayer.start()
+    counts['spooled'] += len(verified)
+
+
+def batch_error(err, verified, counts):
+    """
+    The response for a JSON webhook body that failed part way
+    :param err: the exception
+    :param verified: the batch being processed, released for retry
+    :param counts: dict from batch_counts()
+    :return: (body, status)
+    """
+    # malformed body
+    if isinstance(err, ValueError):
+        return {"Error": "Invalid JSON payload: {}".format(err), "Counts": counts}, 400
+
+    for _, event in verified:
+        release_event(event)
+
+    # broker unavailable, let mailgun retry
+    if isinstance(err, OperationalError):
+        return {"Broker Error": str(err), "Counts": counts}, 503
+
+    # database down and nowhere to spool, let mailgun retry
+    if isinstance(err, (spool.CircuitOpenError, OSError)):
+        return {"Database Error": "Database unavailable", "Counts": counts}, 503
+
+    # database exception
+    db_session.rollback()
+    logger.error('applying a webhook batch failed: %s', err)
+    return {"Database Error": "Unable to apply the events", "Counts": counts}, 500
+
+
+def batch_result(counts):
+    """
+    The response for a processed JSON webhook body
+    :param counts: dict from batch_counts()
+    :return: (body, status)
+    """
+    total = sum(counts.values())
+    if not total:
+        status = 400
+    elif counts['rejected'] == total:
+        status = 409
+    elif counts['stale'] == total:
+        status = 406
+    elif counts['not_found'] and not counts['accepted']:
+        status = 404
+    else:
+        status = 202
+
+    return counts, status
+
+
+def resolve_tenant(event):
+    """
+    Set the event's company from its sending domain, from the in process
+    tenant mapping.  The company picks the signing keys and scopes the
+    lead lookup.
+    :param event: dict from EventType.extract(), updated
+    :return: company id or None
+    """
+    event['company_id'] = tenants.company_for_domain(event.get('domain'))
+    return event['company_id']
+
+
+def verify_event(event):
+    """
+    Check the mailgun signature of a webhook event
+    :param event: dict from EventType.extract()
+    :return: bool
+    """
+    return verifier.verify(
+        event['token'],
+        event['timestamp'],
+        event['signature'],
+        company_id=event.get('company_id')
+    )
+
+
+def replay_status(event):
+    """
+    The cheap checks run before the signature: the event timestamp is
+    fresh and the event has not been seen inside the replay window
+    :param event: dict from EventType.extract()
+    :return: 'stale', 'duplicate' or None
+    """
+    if replay_cache is None:
+        return None
+
+    if replay.is_stale(event, config.WEBHOOK_MAX_AGE):
+        return 'stale'
+
+    if replay_cache.seen(replay.replay_key(event)):
+        return 'duplicate'
+
+    return None
+
+
+def claim_event(event):
+    """
+    Record a verified event in the replay cache
+    :param event:
+    :return: False when another request already claimed it
+    """
+    if replay_cache is None:
+        return True
+    return replay_cache.add(replay.replay_key(event))
+
+
+def release_event(event):
+    """
+    Forget a claimed event that could not be applied, so the mailgun
+    retry is not dropped as a duplicate
+    :param event:
+    :return: None
+    """
+    if replay_cache is not None:
+        replay_cache.discard(replay.replay_key(event))
+
+
+def enqueue_event(kind, form_data):
+    """
+    Push a verified webhook event onto the celery broker
+    :param kind: the event kind
+    :param form_data: dict from EventType.extract()
+    :return: (body, status)
+    """
+    try:
+        apply_webhook_event.apply_async(
+            args=(kind, form_data),
+            queue=config.WEBHOOK_QUEUE
+        )
+
+    # broker unavailable, let mailgun retry
+    except OperationalError as err:
+        release_event(form_data)
+        return {"Broker Error": str(err)}, 503
+
+    return {
+        "event": form_data['event'],
+        "status": 'queued'}, 202
 
 
 def get_date():
@@ -742,18 +985,45 @@ def get_date():
     return '{}'.format(today)
 
 
-def verify(api_key, token, timestamp, signature):
-    hmac_digest = hmac.new(key=mailgun_api_key,
-                           msg='{}{}'.format(timestamp, token).encode('utf-8'),
-                           digestmod=hashlib.sha256).hexdigest()
-    return hmac.compare_digest(signature, hmac_digest)
+def create_app():
+    """
+    The Flask app factory.  Importing this module builds nothing web
+    facing; gunicorn loads wsgi:app and celery workers import tasks.py only.
+    :return: Flask
+    """
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = config.SECRET_KEY
+
+    # disable strict slashes
+    app.url_map.strict_slashes = False
+
+    SSLify(app)
+    mailer.init_mail(app)
+    app.register_blueprint(views)
+
+    # drain whatever an earlier process left in the spool
+    if spool_replayer is not None:
+        spool_replayer.start()
+
+    # the tenant mapping is loaded before the first webhook needs it
+    tenants.tenant_cache.start()
+
+    # every web process receives the whole cluster's events
+    if webhooks.live_feed is not None:
+        webhooks.live_feed.start()
+
+    startup.mark('create_app')
+    return app
+
+
+startup.mark('import_app')
 
 
 if __name__ == '__main__':
     port = 5000
 
     # start the application
-    app.run(
+    create_app().run(
         debug=debug,
         port=port
     )
@@ -0,0 +1,105 @@
+"""
+Load shedding for the webhook routes.
+
+Every webhook holds a slot of its event class while it is handled.  A class
+stops admitting new webhooks once its slots are all taken, or once the
+recent commit latency (an exponentially weighted average) is above the
+class threshold; it then lets only one webhook through at a time, so the
+latency keeps being measured and the class reopens when the database
+recovers.  Shed webhooks get a 503 with Retry-After and mailgun retries
+them later.
+
+High value events (bounces, drops, complaints, unsubscribes) get more
+slots and a higher latency threshold than opens, clicks and deliveries,
+see WEBHOOK_SHED_CLASSES.
+"""
+from threading import Lock
+import config
+
+# event kind -> shedding class, kinds not listed are 'high'
+EVENT_CLASSES = {
+    'delivered': 'low',
+    'click': 'low',
+    'open': 'low'
+}
+
+
+def event_class(kind):
+    """
+    The shedding class of an event kind
+    :param kind: the event kind, None for JSON bodies of mixed events
+    :return: 'high' or 'low'
+    """
+    return EVENT_CLASSES.get(kind, 'high')
+
+
+class LoadShedder(object):
+    """
+    Thread safe in-flight counters and commit latency average, shared by
+    every webhook handler of the process.  ``classes`` maps a class to its
+    ``max_inflight`` slots and ``max_latency`` seconds, ``alpha`` is the
+    weight of the newest latency sample.
+    """
+
+    def __init__(self, classes, alpha=0.2):
+        self.classes = dict(classes)
+        self.alpha = alpha
+        self.latency = 0.0
+        self.inflight = dict((name, 0) for name in self.classes)
+        self._lock = Lock()
+
+    def observe(self, seconds):
+        """
+        Feed a commit latency sample
+        :param seconds:
+        :return: None
+        """
+        with self._lock:
+            self.latency += self.alpha * (seconds - self.latency)
+
+    def admit(self, name):
+        """
+        Take a slot of a class when it has one
+        :param name: the class
+        :return: None when admitted, else why not: 'inflight' or 'latency'
+        """
+        limits = self.classes[name]
+        with self._lock:
+            inflight = self.inflight[name]
+            if inflight >= limits['max_inflight']:
+                return 'inflight'
+            if inflight and self.latency > limits['max_latency']:
+                return 'latency'
+            self.inflight[name] = inflight + 1
+        return None
+
+    def release(self, name):
+        with self._lock:
+            self.inflight[name] -= 1
+
+
+# per process, None when WEBHOOK_SHED_ENABLED is off
+shedder = None
+if config.WEBHOOK_SHED_ENABLED:
+    shedder = LoadShedder(config.WEBHOOK_SHED_CLASSES)
+
+
+def admit(kind):
+    """
+    Take a slot for a webhook of an event kind, see LoadShedder.admit()
+    :param kind: the event kind, None for JSON bodies of mixed events
+    :return: None when admitted, else the reason
+    """
+    if shedder is None:
+        return None
+    return shedder.admit(event_class(kind))
+
+
+def release(kind):
+    if shedder is not None:
+        shedder.release(event_class(kind))
+
+
+def observe(seconds):
+    if shedder is not None:
+        shedder.observe(seconds)
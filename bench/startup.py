@@ -0,0 +1,103 @@
+"""
+Cold start benchmark for the process entry points.
+
+    python -m bench.startup [--runs 10] [--output startup.json]
+
+Starts a fresh interpreter per run for each entry point and reports the
+wall time to a ready process and the time spent importing our code, with
+min/median/max over the runs, plus the startup phases the process
+recorded (see startup.py) and whether the web stack got imported.  This is
+the price every new web or celery worker pays when scaling up.
+"""
+from bench.webhooks import git_commit
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# entry point -> code that brings it to ready
+ENTRY_POINTS = {
+    'celery-worker': 'import tasks',
+    'web': 'import app; app.create_app()',
+    'aioreceiver': 'import aioreceiver; aioreceiver.create_app()'
+}
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+{code}
+import startup
+print(json.dumps({{
+    "import_s": time.perf_counter() - start,
+    "phases": startup.phases,
+    "flask_loaded": 'flask' in sys.modules,
+    "engine_created": 'engine' in startup.phases
+}}))
+'''
+
+
+def run_once(code, cwd):
+    start = time.perf_counter()
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE.format(code=code)],
+        cwd=cwd,
+        stderr=subprocess.DEVNULL
+    )
+    wall = time.perf_counter() - start
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result['wall_s'] = wall
+    return result
+
+
+def spread(values):
+    return {
+        "min": round(min(values), 4),
+        "median": round(statistics.median(values), 4),
+        "max": round(max(values), 4)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--entry', action='append', choices=sorted(ENTRY_POINTS), default=None)
+    parser.add_argument('--output', default=None, help='write the JSON results here as well')
+    args = parser.parse_args()
+
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    entries = {}
+
+    for name in args.entry or sorted(ENTRY_POINTS):
+        try:
+            runs = [run_once(ENTRY_POINTS[name], cwd) for _ in range(args.runs)]
+        except subprocess.CalledProcessError as err:
+            entries[name] = {"error": 'exit status {}'.format(err.returncode)}
+            continue
+
+        entries[name] = {
+            "wall_s": spread([run['wall_s'] for run in runs]),
+            "import_s": spread([run['import_s'] for run in runs]),
+            "phases": runs[-1]['phases'],
+            "flask_loaded": runs[-1]['flask_loaded'],
+            "engine_created": runs[-1]['engine_created']
+        }
+
+    results = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "entry_points": entries
+    }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
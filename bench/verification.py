@@ -0,0 +1,74 @@
+"""
+Signature verification micro-benchmark, single core.
+
+    python -m bench.verification [--seconds 2] [--keys 2]
+
+Reports verifications per second for the one off ``verify_signature``
+and for the prepared ``SignatureVerifier``, one at a time and batched.
+With several keys the signature is made with the last one, the worst case
+during a key rotation.
+"""
+from verification import SignatureVerifier, verify_signature
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import time
+
+
+def make_events(key, count, now):
+    events = []
+    for i in range(count):
+        token = os.urandom(25).hex()
+        timestamp = str(int(now))
+        signature = hmac.new(key, (timestamp + token).encode('utf-8'), hashlib.sha256).hexdigest()
+        events.append((token, timestamp, signature))
+    return events
+
+
+def rate(fn, events, seconds):
+    done = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        fn(events)
+        done += len(events)
+    return done / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--keys', type=int, default=1)
+    parser.add_argument('--events', type=int, default=1000)
+    args = parser.parse_args()
+
+    keys = [os.urandom(32).hex().encode('utf-8') for _ in range(args.keys)]
+    now = time.time()
+    events = make_events(keys[-1], args.events, now)
+    verifier = SignatureVerifier(keys, max_age=900)
+
+    def one_off(items):
+        for token, timestamp, signature in items:
+            any(verify_signature(key, token, timestamp, signature) for key in keys)
+
+    def prepared(items):
+        for token, timestamp, signature in items:
+            verifier.verify(token, timestamp, signature)
+
+    def batch(items):
+        verifier.verify_batch(items)
+
+    assert all(verifier.verify_batch(events))
+
+    results = {
+        "keys": args.keys,
+        "one_off_per_sec": round(rate(one_off, events, args.seconds)),
+        "prepared_per_sec": round(rate(prepared, events, args.seconds)),
+        "batch_per_sec": round(rate(batch, events, args.seconds))
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""
+Webhook route load and latency benchmark.
+
+    python -m bench.webhooks [--requests 1000] [--output results.json]
+
+Posts correctly signed mailgun form webhooks, every event type on every
+webhook route, through the Flask app in process against a throwaway SQLite
+database.  Recipients follow a hot/cold split: --hot-share of the traffic
+goes to the --hot fraction of the leads, --miss of it to unknown addresses
+and --dup of it replays an earlier webhook.  Reports requests per second,
+p50/p95/p99 latency and status codes per route as JSON, tagged with the git
+commit so runs can be compared across commits.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# event kind -> the mailgun form event name
+MAILGUN_EVENTS = {
+    'delivered': 'delivered',
+    'dropped': 'dropped',
+    'bounce': 'bounced',
+    'spam-complaint': 'complained',
+    'unsubscribe': 'unsubscribed',
+    'click': 'clicked',
+    'open': 'opened'
+}
+
+# form fields beyond the common ones, per event kind
+EXTRA_FIELDS = {
+    'dropped': {"reason": 'hardfail', "code": '605', "description": 'Not delivering to previously bounced address'},
+    'bounce': {"code": '550', "error": '5.1.1 The email account that you tried to reach does not exist'},
+    'click': {"ip": '50.56.129.169', "device-type": 'desktop', "client-type": 'browser'},
+    'open': {"ip": '50.56.129.169', "device-type": 'mobile', "client-type": 'mobile browser'}
+}
+
+
+def sign(key, timestamp, token):
+    # the scheme verify() checks: HMAC-SHA256 of timestamp + token
+    return hmac.new(key, (timestamp + token).encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+class Traffic(object):
+    """
+    Signed webhook forms with a realistic recipient mix
+    """
+
+    def __init__(self, key, leads, hot=0.05, hot_share=0.8, miss=0.05, dup=0.05, seed=None):
+        self.key = key
+        self.leads = leads
+        self.hot = leads[:max(1, int(len(leads) * hot))]
+        self.hot_share = hot_share
+        self.miss = miss
+        self.dup = dup
+        self.random = random.Random(seed)
+        self.sent = []
+
+    def recipient(self):
+        roll = self.random.random()
+        if roll < self.miss:
+            return 'missing-{}@bench.invalid'.format(self.random.randrange(10 ** 9))
+        if roll < self.miss + self.hot_share:
+            return self.random.choice(self.hot)
+        return self.random.choice(self.leads)
+
+    def form(self, kind):
+        """
+        The next webhook form for an event kind, sometimes a replay
+        :param kind: the event kind
+        :return: dict
+        """
+        if self.sent and self.random.random() < self.dup:
+            return dict(self.random.choice(self.sent))
+
+        timestamp = str(int(time.time()))
+        token = os.urandom(25).hex()
+        form = {
+            "event": MAILGUN_EVENTS[kind],
+            "recipient": self.recipient(),
+            "domain": 'mg.bench.invalid',
+            "Message-Id": '<{}@mg.bench.invalid>'.format(token[:20]),
+            "campaign-id": 'campaign-{}'.format(self.random.randrange(5)),
+            "timestamp": timestamp,
+            "token": token,
+            "signature": sign(self.key, timestamp, token)
+        }
+        form.update(EXTRA_FIELDS.get(kind, {}))
+
+        self.sent.append(form)
+        if len(self.sent) > 1000:
+            del self.sent[:500]
+        return form
+
+
+def percentile(ordered, pct):
+    # nearest rank on a sorted list
+    if not ordered:
+        return 0.0
+    rank = max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(latencies, elapsed, statuses):
+    ordered = sorted(latencies)
+    return {
+        "requests": len(ordered),
+        "requests_per_sec": round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+        "statuses": dict((str(status), count) for status, count in sorted(statuses.items()))
+    }
+
+
+def run_route(client, rule, kinds, traffic, count):
+    latencies = []
+    statuses = {}
+    start = time.perf_counter()
+
+    for i in range(count):
+        form = traffic.form(kinds[i % len(kinds)])
+        sent = time.perf_counter()
+        resp = client.post(rule, data=form, base_url='https://localhost')
+        latencies.append(time.perf_counter() - sent)
+        statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+
+    return summarize(latencies, time.perf_counter() - start, statuses)
+
+
+def seed_leads(session, models, count):
+    company = models.Company(
+        x_identifier='bench',
+        name='bench',
+        address1='1 Bench St',
+        city='Bench',
+        state='BN',
+        zip_code='00000',
+        contact_email_1='bench@bench.invalid',
+        contact_email_2='bench@bench.invalid',
+        alert_email='bench@bench.invalid',
+        reports_email='bench@bench.invalid',
+        phone_number='0000000000'
+    )
+    session.add(company)
+    session.flush()
+
+    emails = ['lead-{}@bench.invalid'.format(i) for i in range(count)]
+    session.bulk_insert_mappings(models.Lead, [
+        {"company_id": company.id, "email_addr": email, "followup_email_opens": 0, "followup_email_clicks": 0}
+        for email in emails
+    ])
+    session.commit()
+    return emails
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=1000, help='requests per route')
+    parser.add_argument('--leads', type=int, default=10000)
+    parser.add_argument('--hot', type=float, default=0.05, help='fraction of leads that are hot')
+    parser.add_argument('--hot-share', type=float, default=0.8, help='share of traffic to hot leads')
+    parser.add_argument('--miss', type=float, default=0.05, help='share of traffic to unknown recipients')
+    parser.add_argument('--dup', type=float, default=0.05, help='share of traffic replaying a webhook')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--db', default=None, help='database uri, a temporary SQLite file by default')
+    parser.add_argument('--output', default=None, help='write the JSON results here as well')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-webhooks-')
+    uri = args.db or 'sqlite:///{}'.format(os.path.join(workdir, 'bench.sqlite'))
+
+    # point the app at the stand-in database before anything builds the engine
+    import config
+    config.SQLALCHEMY_DATABASE_URI = uri
+    import database
+    import models
+    import webhooks
+    import app
+
+    database.init_db()
+    leads = seed_leads(database.db_session, models, args.leads)
+    database.db_session.remove()
+
+    key = config.MAILGUN_SIGNING_KEYS[0]
+    traffic = Traffic(
+        key if isinstance(key, bytes) else key.encode('utf-8'),
+        leads,
+        hot=args.hot,
+        hot_share=args.hot_share,
+        miss=args.miss,
+        dup=args.dup,
+        seed=args.seed
+    )
+    client = app.create_app().test_client()
+
+    routes = {}
+    for rule, kind in webhooks.WEBHOOK_ROUTES:
+        kinds = sorted(MAILGUN_EVENTS) if kind is None else [kind]
+        routes[rule] = run_route(client, rule, kinds, traffic, args.requests)
+
+    results = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "database": database.get_engine().url.get_backend_name(),
+        "settings": {
+            "requests": args.requests,
+            "leads": args.leads,
+            "hot": args.hot,
+            "hot_share": args.hot_share,
+            "miss": args.miss,
+            "dup": args.dup,
+            "ingest_mode": config.WEBHOOK_INGEST_MODE,
+            "write_behind": config.WEBHOOK_WRITE_BEHIND
+        },
+        "routes": routes
+    }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class TTLCache(object):
+    """
+    A thread safe, size bounded LRU cache where every entry also expires
+    after ``ttl`` seconds.  Keeps simple hit/miss counters.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for key, or default on a miss
+        :param key:
+        :param default:
+        :return: value
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """
+        Store value under key, evicting the least recently used entry when full
+        :param key:
+        :param value:
+        :return: None
+        """
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        Cache counters
+        :return: dict
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "maxsize": self.maxsize
+            }
+
+    def __len__(self):
+        return len(self._data)
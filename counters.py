@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+from redis.exceptions import ResponseError
+from leads import increment_columns
+from models import EngagementFlush
+import redis
+import uuid
+
+
+class EngagementCounters(object):
+    """
+    Open/click counters kept as redis hashes, one hash per Lead column
+    mapping lead id -> pending delta.  Webhooks only ever HINCRBY, so the
+    hot path never takes a row lock in MySQL.  ``flush`` moves the pending
+    deltas into the leads table with server side ``col = col + :delta``
+    updates.
+    """
+
+    def __init__(self, client, columns, prefix='mg:engagement'):
+        self.client = client
+        self.columns = tuple(columns)
+        self.prefix = prefix
+
+    def _key(self, column):
+        return '{}:{}'.format(self.prefix, column)
+
+    def _flushing_key(self, column):
+        return '{}:{}:flushing'.format(self.prefix, column)
+
+    def _flush_id_key(self):
+        return '{}:flush_id'.format(self.prefix)
+
+    def incr(self, lead_id, column, delta=1):
+        """
+        Atomically add delta to a lead's pending counter
+        :param lead_id:
+        :param column: the Lead counter column
+        :param delta:
+        :return: None
+        """
+        self.client.hincrby(self._key(column), lead_id, delta)
+
+    def flush(self, session, lock_timeout=60):
+        """
+        Move the pending deltas into the leads table.
+
+        Each live hash is renamed out of the way before it is read, so
+        increments that land during a flush go to a fresh hash.  The
+        renamed hash is only deleted after the commit, a failed flush is
+        picked up again by the next one.  Every flush has an id, stored in
+        redis and inserted into engagement_flushes with the increments, so
+        a flush that committed but failed to delete its hashes is not
+        applied again.
+        :param session: sqlalchemy session
+        :param lock_timeout: seconds
+        :return: number of leads updated
+        """
+        lock = self.client.lock('{}:lock'.format(self.prefix), timeout=lock_timeout)
+        if not lock.acquire(blocking=False):
+            return 0
+
+        try:
+            flushing_keys = [self._flushing_key(column) for column in self.columns]
+            flush_id = self.client.get(self._flush_id_key())
+            if flush_id is not None:
+                flush_id = flush_id.decode('utf-8')
+                if session.query(EngagementFlush).get(flush_id) is not None:
+                    # committed last time, only the cleanup failed
+                    self.client.delete(self._flush_id_key(), *flushing_keys)
+                    flush_id = None
+                session.close()
+
+            if flush_id is None:
+                flush_id = uuid.uuid4().hex
+                self.client.set(self._flush_id_key(), flush_id)
+
+            increments = {}
+            flushing = []
+
+            for column in self.columns:
+                key = self._flushing_key(column)
+                if not self.client.exists(key):
+                    try:
+                        self.client.rename(self._key(column), key)
+                    except ResponseError:
+                        # nothing pending for this column
+                        continue
+
+                for lead_id, delta in self.client.hgetall(key).items():
+                    deltas = increments.setdefault(int(lead_id), {})
+                    deltas[column] = int(delta)
+                flushing.append(key)
+
+            if increments:
+                now = datetime.now()
+                try:
+                    increment_columns(session, increments)
+                    session.add(EngagementFlush(flush_id=flush_id, flushed_date=now))
+                    session.query(EngagementFlush).filter(
+                        EngagementFlush.flushed_date < now - timedelta(days=1)
+                    ).delete(synchronize_session=False)
+                    session.commit()
+                except Exception:
+                    session.rollback()
+                    raise
+
+            self.client.delete(self._flush_id_key(), *flushing)
+            return len(increments)
+
+        finally:
+            lock.release()
+
+
+def from_url(url, columns, prefix='mg:engagement'):
+    """
+    Build the engagement counters on a redis url
+    :param url: eg. config.CELERY_BROKER_URL
+    :param columns:
+    :param prefix:
+    :return: EngagementCounters
+    """
+    return EngagementCounters(redis.StrictRedis.from_url(url), columns, prefix=prefix)
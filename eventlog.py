@@ -0,0 +1,159 @@
+from datetime import date, datetime, timedelta
+from sqlalchemy import text
+from models import LeadEvent
+from writebehind import BufferedWriter
+import replay
+
+
+class EventLogWriter(BufferedWriter):
+    """
+    Buffered writer for the lead_events log.  Rows are appended in memory
+    and written with multi-row INSERTs of up to ``chunk_size`` rows, so the
+    log never contends for row locks on leads.  Rows whose event is already
+    logged (same event_key) are skipped.
+    """
+
+    name = 'lead-event-log'
+
+    def __init__(self, session_factory, flush_interval=1.0, max_events=5000, chunk_size=1000):
+        super(EventLogWriter, self).__init__(session_factory, flush_interval, max_events)
+        self.chunk_size = chunk_size
+        self._rows = []
+
+    def add(self, row):
+        """
+        Buffer a lead_events row
+        :param row: dict from event_row()
+        :return: None
+        """
+        with self._lock:
+            self._rows.append(row)
+            pending = self._added()
+
+        self._notify(pending)
+
+    def _take(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def _write(self, session, rows):
+        table = LeadEvent.__table__
+        for start in range(0, len(rows), self.chunk_size):
+            session.execute(
+                table.insert().prefix_with('IGNORE', dialect='mysql').prefix_with(
+                    'OR IGNORE', dialect='sqlite'
+                ).values(rows[start:start + self.chunk_size])
+            )
+        return len(rows)
+
+    def _split(self, rows):
+        return [[row] for row in rows]
+
+    def _requeue(self, rows):
+        # keep the log in arrival order
+        self._rows[:0] = rows
+        self._pending += len(rows)
+
+
+def event_time(event):
+    """
+    When a webhook event happened, from its timestamp
+    :param event: dict from EventType.extract()
+    :return: datetime
+    """
+    try:
+        return datetime.fromtimestamp(float(event.get('timestamp')))
+    except (TypeError, ValueError):
+        return datetime.now()
+
+
+def event_row(kind, event, lead):
+    """
+    The lead_events row for an applied webhook event
+    :param kind: the event kind
+    :param event: dict from EventType.extract()
+    :param lead: LeadRef
+    :return: dict
+    """
+    when = event_time(event)
+
+    return {
+        "event_date": when.date(),
+        "event_time": when,
+        "lead_id": lead.id,
+        "company_id": lead.company_id,
+        "event": kind,
+        "event_key": replay.replay_key(event).hex(),
+        "message_id": event.get('message_id'),
+        "ip": event.get('ip'),
+        "device": event.get('device_type'),
+        "client": event.get('client_type'),
+        "code": event.get('code'),
+        "reason": event.get('reason') or event.get('error') or event.get('description')
+    }
+
+
+def _partition_name(day):
+    return day.strftime('p%Y%m%d')
+
+
+def _partitions(connection):
+    rows = connection.execute(text(
+        "SELECT partition_name FROM information_schema.partitions "
+        "WHERE table_schema = DATABASE() AND table_name = 'lead_events' "
+        "AND partition_name IS NOT NULL"
+    ))
+    return set(row[0] for row in rows)
+
+
+def add_partitions(connection, days_ahead=7, today=None):
+    """
+    Split daily partitions for today and the next days_ahead days off the
+    catch all pmax partition.  MySQL only.
+    :param connection: sqlalchemy connection
+    :param days_ahead:
+    :param today:
+    :return: list of partition names added
+    """
+    today = today or date.today()
+    existing = _partitions(connection)
+
+    added = []
+    for offset in range(days_ahead + 1):
+        day = today + timedelta(days=offset)
+        name = _partition_name(day)
+        if name not in existing:
+            added.append((name, day + timedelta(days=1)))
+
+    if added:
+        connection.execute(text(
+            "ALTER TABLE lead_events REORGANIZE PARTITION pmax INTO ({}, "
+            "PARTITION pmax VALUES LESS THAN MAXVALUE)".format(', '.join(
+                "PARTITION {} VALUES LESS THAN (TO_DAYS('{}'))".format(name, bound.isoformat())
+                for name, bound in added
+            ))
+        ))
+
+    return [name for name, _ in added]
+
+
+def drop_partitions(connection, keep_days=90, today=None):
+    """
+    Drop the daily partitions older than keep_days.  MySQL only.
+    :param connection: sqlalchemy connection
+    :param keep_days:
+    :param today:
+    :return: list of partition names dropped
+    """
+    cutoff = _partition_name((today or date.today()) - timedelta(days=keep_days))
+    dropped = sorted(
+        name for name in _partitions(connection)
+        if name != 'pmax' and name < cutoff
+    )
+
+    if dropped:
+        connection.execute(text(
+            "ALTER TABLE lead_events DROP PARTITION {}".format(', '.join(dropped))
+        ))
+
+    return dropped
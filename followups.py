@@ -0,0 +1,254 @@
+"""
+Follow-up campaign dispatcher.
+
+Finds the leads still waiting for their follow-up email (not processed,
+not opted out, status EMAILNOTSENT) with keyset pagination on the primary
+key and hands them out as chunks of FOLLOWUP_CHUNK_SIZE lead ids.  The
+dispatcher claims each chunk (status EMAILQUEUED) before queueing it, so
+a second dispatch never sends twice, and the chunk tasks share nothing
+but the database: adding workers adds throughput.
+
+Each chunk task loads its leads, sends the emails and records the sent
+dates and receipt ids (the Message-Id) with bulk executemany UPDATEs.
+"""
+from datetime import datetime
+from sqlalchemy import bindparam, and_
+from models import Lead, Company
+import os
+import jinja2
+import sendlog
+import suppression
+import config
+
+# followup_email_status values written here; webhooks overwrite the
+# status with the mailgun event name once the message is out
+NOT_SENT = 'EMAILNOTSENT'
+QUEUED = 'EMAILQUEUED'
+SENT = 'EMAILSENT'
+FAILED = 'EMAILFAILED'
+SUPPRESSED = 'EMAILSUPPRESSED'
+
+_templates = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')),
+    autoescape=True
+)
+
+
+def pending_filter(company_id=None):
+    """
+    The leads due a follow-up
+    :param company_id: only this company's leads, all companies when None
+    :return: list of sqlalchemy criteria
+    """
+    criteria = [
+        Lead.is_processed.is_(False),
+        Lead.is_optout.is_(False),
+        Lead.followup_email_status == NOT_SENT
+    ]
+    if company_id is not None:
+        criteria.append(Lead.company_id == company_id)
+    return criteria
+
+
+def iter_chunks(session, company_id=None, chunk_size=None):
+    """
+    Ids of the leads due a follow-up, a chunk at a time in id order.  Every
+    chunk is a fresh ``WHERE ... AND id > :last ORDER BY id LIMIT :n``
+    query on the primary key.
+    :param session: sqlalchemy session
+    :param company_id: only this company's leads, all companies when None
+    :param chunk_size: defaults to FOLLOWUP_CHUNK_SIZE
+    :return: generator of lists of lead ids
+    """
+    chunk_size = chunk_size or config.FOLLOWUP_CHUNK_SIZE
+    criteria = pending_filter(company_id)
+    last_id = 0
+
+    while True:
+        chunk = [row[0] for row in session.query(Lead.id).filter(
+            Lead.id > last_id,
+            *criteria
+        ).order_by(Lead.id).limit(chunk_size)]
+
+        if not chunk:
+            return
+
+        yield chunk
+        last_id = chunk[-1]
+
+
+def claim(session, lead_ids):
+    """
+    Mark a chunk of leads as queued, skipping any that changed since the
+    scan.  The leads still due are read with SELECT ... FOR UPDATE, so an
+    overlapping dispatch waits for this one to commit and then sees them
+    queued.  Does not commit.
+    :param session: sqlalchemy session
+    :param lead_ids: list of lead ids
+    :return: list of the lead ids claimed
+    """
+    claimed = [row[0] for row in session.query(Lead.id).filter(
+        Lead.id.in_(lead_ids),
+        *pending_filter()
+    ).with_for_update()]
+
+    if claimed:
+        session.query(Lead).filter(
+            Lead.id.in_(claimed)
+        ).update({Lead.followup_email_status: QUEUED}, synchronize_session=False)
+    return claimed
+
+
+def dispatch(session, send_chunk, company_id=None, chunk_size=None):
+    """
+    Claim the leads due a follow-up chunk by chunk and queue every chunk
+    :param session: sqlalchemy session
+    :param send_chunk: the send_followup_chunk celery task
+    :param company_id: only this company's leads, all companies when None
+    :param chunk_size: defaults to FOLLOWUP_CHUNK_SIZE
+    :return: dict with the chunk and lead counts
+    """
+    stats = {"chunks": 0, "leads": 0}
+
+    for chunk in iter_chunks(session, company_id, chunk_size):
+        try:
+            claimed = claim(session, chunk)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        if claimed:
+            send_chunk.apply_async(args=(claimed,))
+            stats['chunks'] += 1
+            stats['leads'] += len(claimed)
+
+    return stats
+
+
+def followup_payload(lead_id, company_id, email_addr, company_name):
+    """
+    The follow-up email for one lead
+    :param lead_id:
+    :param company_id:
+    :param email_addr:
+    :param company_name:
+    :return: dict from mailer.email_payload()
+    """
+    import mailer
+
+    template = _templates.get_template(config.FOLLOWUP_TEMPLATE)
+    return mailer.email_payload(
+        email_addr,
+        config.FOLLOWUP_SUBJECT.format(company=company_name),
+        template.render(email_addr=email_addr, company=company_name),
+        lead_id=lead_id,
+        company_id=company_id
+    )
+
+
+def chunk_payloads(session, lead_ids):
+    """
+    The follow-up emails for the claimed leads of a chunk, with one query.
+    Leads whose address is suppressed get no email.
+    :param session: sqlalchemy session
+    :param lead_ids: list of lead ids
+    :return: (list of payload dicts, list of suppressed lead ids)
+    """
+    rows = session.query(Lead.id, Lead.company_id, Lead.email_addr, Company.name).join(
+        Company, Company.id == Lead.company_id
+    ).filter(
+        Lead.id.in_(lead_ids),
+        Lead.followup_email_status == QUEUED,
+        Lead.is_optout.is_(False)
+    ).order_by(Lead.id).all()
+
+    # nothing is held open while the chunk talks SMTP
+    session.close()
+
+    payloads = []
+    suppressed = []
+    for lead_id, company_id, email_addr, company_name in rows:
+        if suppression.is_suppressed(email_addr, company_id):
+            suppressed.append(lead_id)
+        else:
+            payloads.append(followup_payload(lead_id, company_id, email_addr, company_name))
+    return payloads, suppressed
+
+
+def record_results(session, sent, failed, suppressed=()):
+    """
+    Write a chunk's outcome with executemany UPDATEs.  The status only
+    moves on from EMAILQUEUED, a webhook that beat us to it keeps its
+    event.  The Message-Ids go to the send log in the same transaction.
+    Commits.
+    :param session: sqlalchemy session
+    :param sent: payloads from mailer.send_batch(), carrying the message_id
+    :param failed: payloads refused for good
+    :param suppressed: lead ids skipped for a suppressed address
+    :return: None
+    """
+    leads = Lead.__table__
+    now = datetime.now()
+
+    try:
+        if sent:
+            rows = [
+                {"lead_id": payload['lead_id'], "sent_date": now, "receipt_id": payload['message_id']}
+                for payload in sent
+            ]
+            session.execute(
+                leads.update().where(leads.c.id == bindparam('lead_id')).values(
+                    is_processed=True,
+                    followup_email_sent_date=bindparam('sent_date'),
+                    followup_email_receipt_id=bindparam('receipt_id')
+                ),
+                rows
+            )
+            session.execute(
+                leads.update().where(and_(
+                    leads.c.id == bindparam('lead_id'),
+                    leads.c.followup_email_status == QUEUED
+                )).values(followup_email_status=SENT),
+                rows
+            )
+            sendlog.record_sends(session, sent, now)
+        if failed:
+            session.execute(
+                leads.update().where(and_(
+                    leads.c.id == bindparam('lead_id'),
+                    leads.c.followup_email_status == QUEUED
+                )).values(is_processed=True, followup_email_status=FAILED),
+                [{"lead_id": payload['lead_id']} for payload in failed]
+            )
+        if suppressed:
+            session.execute(
+                leads.update().where(and_(
+                    leads.c.id == bindparam('lead_id'),
+                    leads.c.followup_email_status == QUEUED
+                )).values(is_processed=True, followup_email_status=SUPPRESSED),
+                [{"lead_id": lead_id} for lead_id in suppressed]
+            )
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
+def release(session, lead_ids):
+    """
+    Put leads whose chunk gave up back to EMAILNOTSENT for the next
+    dispatch.  Commits.
+    :param session: sqlalchemy session
+    :param lead_ids: list of lead ids
+    :return: None
+    """
+    try:
+        session.query(Lead).filter(
+            Lead.id.in_(lead_ids),
+            Lead.followup_email_status == QUEUED
+        ).update({Lead.followup_email_status: NOT_SENT}, synchronize_session=False)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
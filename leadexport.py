@@ -0,0 +1,161 @@
+"""
+Streaming lead export.
+
+Writes a company's leads with their webhook state as CSV or NDJSON.  Leads
+are read with keyset pagination on the primary key, LEAD_EXPORT_PAGE_SIZE
+rows per query, so memory stays flat and no query ever skips rows with
+OFFSET.
+
+    python leadexport.py --company 3 --format csv > leads.csv
+"""
+from datetime import date, datetime
+from models import Lead
+from database import db_session
+import argparse
+import csv
+import io
+import json
+import sys
+import config
+
+# the exported columns, in output order
+EXPORT_COLUMNS = (
+    'id',
+    'email_addr',
+    'is_verified',
+    'is_optout',
+    'is_processed',
+    'followup_email_sent_date',
+    'followup_email_receipt_id',
+    'followup_email_status',
+    'followup_email_delivered',
+    'followup_email_bounced',
+    'followup_email_dropped',
+    'followup_email_spam',
+    'followup_email_unsub',
+    'followup_email_opens',
+    'followup_email_clicks',
+    'followup_email_open_campaign',
+    'followup_email_open_ip',
+    'followup_email_open_device',
+    'followup_email_click_ip',
+    'followup_email_click_device',
+    'dropped_reason',
+    'dropped_code',
+    'dropped_description',
+    'bounce_error',
+    'webhook_last_updated'
+)
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson'
+}
+
+
+def iter_pages(session, company_id, page_size=None):
+    """
+    A company's leads, one page at a time in id order.  Every page is a
+    fresh ``WHERE company_id = :c AND id > :last ORDER BY id LIMIT :n``
+    query, and the connection goes back to the pool between pages.
+    :param session: sqlalchemy session
+    :param company_id:
+    :param page_size: defaults to LEAD_EXPORT_PAGE_SIZE
+    :return: generator of lists of row tuples, see EXPORT_COLUMNS
+    """
+    page_size = page_size or config.LEAD_EXPORT_PAGE_SIZE
+    leads = Lead.__table__
+    columns = [leads.c[column] for column in EXPORT_COLUMNS]
+    last_id = 0
+
+    while True:
+        page = session.query(*columns).filter(
+            leads.c.company_id == company_id,
+            leads.c.id > last_id
+        ).order_by(leads.c.id).limit(page_size).all()
+        session.close()
+
+        if not page:
+            return
+
+        yield page
+        last_id = page[-1][0]
+
+
+def _value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def iter_csv(pages):
+    """
+    CSV text, a header line then one chunk per page
+    :param pages: generator from iter_pages()
+    :return: generator of str
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUMNS)
+
+    for page in pages:
+        for row in page:
+            writer.writerow([
+                int(value) if isinstance(value, bool) else _value(value)
+                for value in row
+            ])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+    # only the header, for a company without leads
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def iter_ndjson(pages):
+    """
+    NDJSON text, one chunk per page
+    :param pages: generator from iter_pages()
+    :return: generator of str
+    """
+    for page in pages:
+        yield ''.join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, [_value(value) for value in row]))) + '\n'
+            for row in page
+        )
+
+
+def iter_export(session, company_id, fmt, page_size=None):
+    """
+    Stream a company's leads as CSV or NDJSON
+    :param session: sqlalchemy session
+    :param company_id:
+    :param fmt: 'csv' or 'ndjson'
+    :param page_size: defaults to LEAD_EXPORT_PAGE_SIZE
+    :return: generator of str
+    """
+    pages = iter_pages(session, company_id, page_size)
+    if fmt == 'csv':
+        return iter_csv(pages)
+    if fmt == 'ndjson':
+        return iter_ndjson(pages)
+    raise ValueError('Unknown export format: {}'.format(fmt))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--company', type=int, required=True, help='company id')
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+    parser.add_argument('--page-size', type=int, default=config.LEAD_EXPORT_PAGE_SIZE)
+    args = parser.parse_args()
+
+    try:
+        for chunk in iter_export(db_session, args.company, args.format, args.page_size):
+            sys.stdout.write(chunk)
+    finally:
+        db_session.remove()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+"""
+Streaming lead import.
+
+Reads CSV or NDJSON leads for a company and upserts them on
+(company_id, email_addr) in chunks, one multi-row
+INSERT ... ON DUPLICATE KEY UPDATE and one commit per chunk, so memory
+stays flat whatever the size of the list.
+
+    python leadimport.py --company 3 leads.csv
+    python leadimport.py --company 3 --format ndjson - < leads.ndjson
+"""
+from datetime import datetime
+from itertools import islice
+from sqlalchemy.dialects import mysql
+from models import Lead, Company
+from leads import invalidate_lead
+from database import db_session
+from webhooks import iter_json_documents
+import argparse
+import csv
+import io
+import sys
+import time
+import config
+
+# input field -> leads column, anything else in a row is ignored
+IMPORT_FIELDS = {
+    'email_addr': 'email_addr',
+    'email': 'email_addr',
+    'is_verified': 'is_verified',
+    'is_optout': 'is_optout',
+    'is_processed': 'is_processed'
+}
+
+BOOLEAN_COLUMNS = ('is_verified', 'is_optout', 'is_processed')
+
+# content types -> import format
+IMPORT_FORMATS = {
+    'text/csv': 'csv',
+    'application/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/json': 'ndjson'
+}
+
+
+def _boolean(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 't', 'yes', 'y')
+
+
+def iter_csv(stream):
+    """
+    Rows of a CSV body with a header line
+    :param stream: file like object returning bytes
+    :return: generator of dict
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        for row in csv.DictReader(text):
+            yield row
+    except csv.Error as err:
+        raise ValueError('Invalid CSV: {}'.format(err))
+
+
+def iter_rows(stream, fmt):
+    """
+    Rows of a CSV or NDJSON body
+    :param stream: file like object returning bytes
+    :param fmt: 'csv' or 'ndjson'
+    :return: generator of dict
+    """
+    if fmt == 'csv':
+        return iter_csv(stream)
+    if fmt == 'ndjson':
+        return iter_json_documents(stream)
+    raise ValueError('Unknown import format: {}'.format(fmt))
+
+
+def lead_row(company_id, row):
+    """
+    The leads columns for an input row
+    :param company_id:
+    :param row: dict from the input
+    :return: dict, or None when the row has no usable email address
+    """
+    if not isinstance(row, dict):
+        return None
+
+    lead = {}
+    for field, value in row.items():
+        column = IMPORT_FIELDS.get(field)
+        if column is None or value is None or value == '':
+            continue
+        lead[column] = _boolean(value) if column in BOOLEAN_COLUMNS else str(value).strip()
+
+    email_addr = lead.get('email_addr', '')
+    if '@' not in email_addr or len(email_addr) > 255:
+        return None
+
+    lead['company_id'] = company_id
+    return lead
+
+
+def upsert_leads(session, company_id, rows):
+    """
+    Upsert one chunk of lead rows on (company_id, email_addr).  MySQL gets
+    a multi-row INSERT ... ON DUPLICATE KEY UPDATE per set of columns,
+    other databases one SELECT of the existing leads followed by a bulk
+    update and a bulk insert.  Columns missing from a row are left alone
+    on existing leads.  Does not commit.
+    :param session: sqlalchemy session
+    :param company_id:
+    :param rows: list of dict from lead_row(), unique per email address
+    :return: None
+    """
+    if not rows:
+        return
+
+    now = datetime.now()
+
+    if session.get_bind().dialect.name == 'mysql':
+        by_columns = {}
+        for row in rows:
+            by_columns.setdefault(tuple(sorted(row)), []).append(row)
+
+        for columns, group in by_columns.items():
+            for row in group:
+                row['create_date'] = now
+            stmt = mysql.insert(Lead.__table__).values(group)
+            updates = dict(
+                (column, stmt.inserted[column]) for column in columns
+                if column not in ('company_id', 'email_addr')
+            )
+            updates['modified_date'] = now
+            session.execute(stmt.on_duplicate_key_update(**updates))
+        return
+
+    existing = {}
+    emails = [row['email_addr'] for row in rows]
+    for start in range(0, len(emails), 500):
+        existing.update(session.query(Lead.email_addr, Lead.id).filter(
+            Lead.company_id == company_id,
+            Lead.email_addr.in_(emails[start:start + 500])
+        ))
+
+    updates = []
+    inserts = []
+    for row in rows:
+        if row['email_addr'] in existing:
+            row['id'] = existing[row['email_addr']]
+            row['modified_date'] = now
+            updates.append(row)
+        else:
+            row['create_date'] = now
+            inserts.append(row)
+
+    if updates:
+        session.bulk_update_mappings(Lead, updates)
+    if inserts:
+        session.bulk_insert_mappings(Lead, inserts)
+
+
+def import_stats():
+    return {"rows": 0, "upserted": 0, "skipped": 0, "chunks": 0, "elapsed": 0.0, "rows_per_sec": 0.0}
+
+
+def iter_import(session, company_id, rows, chunk_size=None):
+    """
+    Stream rows into the leads table for a company, one transaction per
+    chunk.  A failed chunk is rolled back and raised; the chunks before it
+    stay committed, and importing the file again is safe.
+    :param session: sqlalchemy session
+    :param company_id:
+    :param rows: iterable of dict, eg. from iter_rows()
+    :param chunk_size: defaults to LEAD_IMPORT_CHUNK_SIZE
+    :return: generator of the running stats, one after every chunk
+    """
+    chunk_size = chunk_size or config.LEAD_IMPORT_CHUNK_SIZE
+    start = time.time()
+    stats = import_stats()
+    iterator = iter(rows)
+
+    while True:
+        raw = list(islice(iterator, chunk_size))
+        if not raw:
+            break
+
+        # last row wins for an address repeated within the chunk
+        chunk = {}
+        for row in raw:
+            lead = lead_row(company_id, row)
+            if lead is None:
+                stats['skipped'] += 1
+            else:
+                chunk[lead['email_addr']] = lead
+
+        try:
+            upsert_leads(session, company_id, list(chunk.values()))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        # addresses cached as unknown by the webhooks resolve from now on
+        for email_addr in chunk:
+            invalidate_lead(email_addr, company_id)
+
+        stats['rows'] += len(raw)
+        stats['upserted'] += len(chunk)
+        stats['chunks'] += 1
+        stats['elapsed'] = round(time.time() - start, 3)
+        stats['rows_per_sec'] = round(stats['rows'] / stats['elapsed'], 1) if stats['elapsed'] else 0.0
+        yield dict(stats)
+
+
+def import_leads(session, company_id, rows, chunk_size=None, progress=None):
+    """
+    Run a whole import, see iter_import()
+    :param session: sqlalchemy session
+    :param company_id:
+    :param rows: iterable of dict
+    :param chunk_size: defaults to LEAD_IMPORT_CHUNK_SIZE
+    :param progress: called with the stats after every chunk
+    :return: stats dict
+    """
+    stats = import_stats()
+    for stats in iter_import(session, company_id, rows, chunk_size):
+        if progress is not None:
+            progress(stats)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('path', help="CSV or NDJSON file, '-' for stdin")
+    parser.add_argument('--company', type=int, required=True, help='company id')
+    parser.add_argument('--format', choices=('csv', 'ndjson'), default=None,
+                        help='defaults from the file extension, csv for stdin')
+    parser.add_argument('--chunk-size', type=int, default=config.LEAD_IMPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if db_session.query(Company.id).filter(Company.id == args.company).first() is None:
+        parser.error('no company with id {}'.format(args.company))
+
+    fmt = args.format
+    if fmt is None:
+        fmt = 'ndjson' if args.path.endswith(('.ndjson', '.jsonl', '.json')) else 'csv'
+
+    def report(stats):
+        sys.stderr.write('{rows} rows, {upserted} upserted, {skipped} skipped, '
+                         '{rows_per_sec} rows/s\n'.format(**stats))
+
+    stream = sys.stdin.buffer if args.path == '-' else open(args.path, 'rb')
+    try:
+        stats = import_leads(
+            db_session,
+            args.company,
+            iter_rows(stream, fmt),
+            chunk_size=args.chunk_size,
+            progress=report
+        )
+    finally:
+        stream.close()
+        db_session.remove()
+
+    sys.stderr.write('done in {elapsed}s\n'.format(**stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+from collections import namedtuple
+from sqlalchemy import bindparam, event, inspect
+from database import db_session
+from models import Lead, SendLog
+from cache import TTLCache
+from sendlog import message_key
+import config
+
+# (company id, recipient email address) -> LeadRef, the company id is None
+# for lookups across companies.  Misses are cached as None so bursts for
+# unknown recipients do not hit the database either.
+lead_cache = TTLCache(maxsize=config.LEAD_CACHE_SIZE, ttl=config.LEAD_CACHE_TTL)
+
+# Message-Id -> LeadRef, from the send log.  Send log rows never change,
+# only hits are cached.
+message_cache = TTLCache(maxsize=config.LEAD_CACHE_SIZE, ttl=config.LEAD_CACHE_TTL)
+
+LeadRef = namedtuple('LeadRef', 'id company_id')
+
+_MISSING = object()
+
+
+def get_lead_ref(recipient, company_id=None):
+    """
+    Resolve a webhook recipient to its lead and company ids, going through
+    the lead cache.  With a company id the lookup is one probe of the
+    (company_id, email_addr) unique index; without, the first lead with
+    the address in any company.
+    :param recipient: email address
+    :param company_id: the company the webhook belongs to, see tenants.py
+    :return: LeadRef or None
+    """
+    if not recipient:
+        return None
+
+    key = (company_id, recipient)
+    ref = lead_cache.get(key, _MISSING)
+
+    if ref is _MISSING:
+        query = db_session.query(Lead.id, Lead.company_id)
+        if company_id is not None:
+            query = query.filter(Lead.company_id == company_id, Lead.email_addr == recipient)
+        else:
+            query = query.filter(Lead.email_addr == recipient)
+        row = query.first()
+        ref = LeadRef(row.id, row.company_id) if row else None
+        lead_cache.set(key, ref)
+
+    return ref
+
+
+def invalidate_lead(email_addr, company_id=None):
+    """
+    Drop the cached lookups of an address, scoped and across companies
+    :param email_addr:
+    :param company_id:
+    :return: None
+    """
+    lead_cache.invalidate((None, email_addr))
+    if company_id is not None:
+        lead_cache.invalidate((company_id, email_addr))
+
+
+def get_message_ref(message_id):
+    """
+    Resolve a webhook Message-Id to the lead it was sent to, through the
+    send log
+    :param message_id: the Message-Id, with or without angle brackets
+    :return: LeadRef or None
+    """
+    key = message_key(message_id)
+    if key is None:
+        return None
+
+    ref = message_cache.get(key)
+
+    if ref is None:
+        row = db_session.query(SendLog.lead_id, SendLog.company_id).filter(
+            SendLog.message_id == key
+        ).first()
+        if row is None:
+            return None
+        ref = LeadRef(row.lead_id, row.company_id)
+        message_cache.set(key, ref)
+
+    return ref
+
+
+def get_event_ref(event):
+    """
+    Resolve a webhook event to its lead, by Message-Id first and by the
+    recipient address within the event's company for messages not in the
+    send log.  A Message-Id sent by another company than the one the
+    event's domain resolved to is ignored, one company's webhooks never
+    touch another's leads.
+    :param event: dict with message_id, recipient and company_id
+    :return: LeadRef or None
+    """
+    company_id = event.get('company_id')
+    ref = get_message_ref(event.get('message_id'))
+
+    if ref is not None and (company_id is None or ref.company_id == company_id):
+        return ref
+
+    return get_lead_ref(event.get('recipient'), company_id)
+
+
+def _load_lead(lead_id, recipient=None, message_id=None, company_id=None):
+    lead = db_session.query(Lead).get(lead_id)
+
+    # the lead was removed outside of this process
+    if lead is None:
+        if recipient:
+            invalidate_lead(recipient, company_id)
+        if message_key(message_id):
+            message_cache.invalidate(message_key(message_id))
+
+    return lead
+
+
+def get_event_lead(event):
+    """
+    Resolve a webhook event to a Lead, see get_event_ref()
+    :param event: dict with message_id, recipient and company_id
+    :return: Lead or None
+    """
+    ref = get_event_ref(event)
+
+    if ref is None:
+        return None
+
+    return _load_lead(
+        ref.id,
+        recipient=event.get('recipient'),
+        message_id=event.get('message_id'),
+        company_id=event.get('company_id')
+    )
+
+
+def increment_columns(session, increments):
+    """
+    Apply counter deltas server side, ``col = col + :delta``, with one
+    executemany UPDATE per column.  Does not commit.
+    :param session: sqlalchemy session
+    :param increments: {lead_id: {column: delta}}
+    :return: None
+    """
+    grouped = {}
+    for lead_id, deltas in increments.items():
+        for column, delta in deltas.items():
+            grouped.setdefault(column, []).append({"_id": lead_id, "_delta": delta})
+
+    leads = Lead.__table__
+    for column, params in grouped.items():
+        session.execute(
+            leads.update().where(
+                leads.c.id == bindparam('_id')
+            ).values({
+                column: leads.c[column] + bindparam('_delta')
+            }),
+            params
+        )
+
+
+# keep the cache honest for changes made through the ORM in this process,
+# anything else ages out with LEAD_CACHE_TTL
+@event.listens_for(Lead, 'after_insert')
+@event.listens_for(Lead, 'after_delete')
+def _invalidate_lead(mapper, connection, target):
+    invalidate_lead(target.email_addr, target.company_id)
+
+
+@event.listens_for(Lead, 'after_update')
+def _invalidate_lead_email(mapper, connection, target):
+    history = inspect(target).attrs.email_addr.history
+    for email_addr in tuple(history.added or ()) + tuple(history.deleted or ()):
+        invalidate_lead(email_addr, target.company_id)
@@ -0,0 +1,293 @@
+"""
+Live engagement feed for the dashboard.
+
+Applied webhook events are kept in a fixed size ring buffer together with
+per second counts per company and event kind, all in memory, and streamed
+to browsers over Server-Sent Events.  With LIVE_FEED = 'redis' every
+process publishes its events on a redis pub/sub channel and every web
+process subscribes to it, so each ring buffer sees the events of the whole
+cluster, including the ones celery workers apply in queue ingest mode.
+Nothing here touches MySQL.
+"""
+from collections import deque
+from threading import Condition, Lock, Thread
+import json
+import logging
+import os
+import queue
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RingBuffer(object):
+    """
+    The last ``size`` items, each with an increasing sequence number.
+    Readers block in wait() until something newer than what they have seen
+    arrives.
+    """
+
+    def __init__(self, size=1000):
+        self.seq = 0
+        self._items = deque(maxlen=size)
+        self._cond = Condition()
+
+    def append(self, item):
+        with self._cond:
+            self.seq += 1
+            self._items.append((self.seq, item))
+            self._cond.notify_all()
+            return self.seq
+
+    def since(self, seq):
+        """
+        The items newer than seq still in the buffer
+        :param seq: the last sequence number seen, 0 for everything
+        :return: list of (seq, item)
+        """
+        with self._cond:
+            if seq >= self.seq:
+                return []
+            return [(n, item) for n, item in self._items if n > seq]
+
+    def wait(self, seq, timeout):
+        """
+        Block until an item newer than seq arrives or timeout passes
+        :param seq:
+        :param timeout: seconds
+        :return: list of (seq, item)
+        """
+        with self._cond:
+            if seq >= self.seq:
+                self._cond.wait(timeout)
+        return self.since(seq)
+
+
+class SecondCounters(object):
+    """
+    Event counts per second, company and event kind for the last
+    ``window`` seconds
+    """
+
+    def __init__(self, window=60):
+        self.window = window
+        self._seconds = deque()
+        self._lock = Lock()
+
+    def add(self, company_id, kind, when=None):
+        second = int(when if when is not None else time.time())
+        with self._lock:
+            if not self._seconds or self._seconds[-1][0] < second:
+                self._seconds.append((second, {}))
+                while self._seconds and self._seconds[0][0] <= second - self.window:
+                    self._seconds.popleft()
+            for bucket_second, counts in reversed(self._seconds):
+                if bucket_second <= second:
+                    counts[(company_id, kind)] = counts.get((company_id, kind), 0) + 1
+                    break
+
+    def company(self, company_id, seconds=None):
+        """
+        A company's counts, second by second
+        :param company_id:
+        :param seconds: how far back, defaults to the window
+        :return: list of {"t": second, kind: count, ...}, oldest first
+        """
+        since = int(time.time()) - (seconds or self.window)
+        with self._lock:
+            buckets = [(second, counts) for second, counts in self._seconds if second > since]
+
+        rows = []
+        for second, counts in buckets:
+            row = dict((kind, count) for (owner, kind), count in counts.items() if owner == company_id)
+            if row:
+                row['t'] = second
+                rows.append(row)
+        return rows
+
+
+def event_record(kind, event, ref):
+    """
+    What the dashboard shows of an applied webhook event
+    :param kind: the event kind
+    :param event: dict from EventType.extract()
+    :param ref: leads.LeadRef
+    :return: dict
+    """
+    return {
+        "t": time.time(),
+        "kind": kind,
+        "company_id": ref.company_id,
+        "lead_id": ref.id,
+        "recipient": event.get('recipient'),
+        "campaign": event.get('campaign'),
+        "device": event.get('device_type')
+    }
+
+
+class LiveFeed(object):
+    """
+    The per process ring buffer and counters, fed directly
+    """
+
+    def __init__(self, size=1000, window=60):
+        # stream event ids are only meaningful to the process issuing them
+        self.origin = os.urandom(4).hex()
+        self.events = RingBuffer(size)
+        self.counters = SecondCounters(window)
+
+    def event_id(self, seq):
+        return '{}-{}'.format(self.origin, seq)
+
+    def last_seq(self, event_id):
+        """
+        The sequence number of a Last-Event-ID this feed issued; 0, the
+        whole buffer, for one from another process (a reconnect landing on
+        another worker) or none
+        :param event_id: str or None
+        :return: int
+        """
+        origin, _, seq = (event_id or '').partition('-')
+        if origin != self.origin or not seq.isdigit():
+            return 0
+        return int(seq)
+
+    def publish(self, kind, event, ref):
+        self.deliver(event_record(kind, event, ref))
+
+    def deliver(self, record):
+        self.counters.add(record['company_id'], record['kind'], record['t'])
+        self.events.append(record)
+
+    def start(self):
+        pass
+
+
+class RedisLiveFeed(LiveFeed):
+    """
+    LiveFeed fanned out over a redis pub/sub channel.  publish() hands the
+    record to a background publisher so the webhook never waits on redis;
+    a subscriber thread, started by the web processes, delivers every
+    record of the channel into the local buffer.
+    """
+
+    def __init__(self, client, channel, size=1000, window=60, max_pending=10000):
+        super(RedisLiveFeed, self).__init__(size, window)
+        self.client = client
+        self.channel = channel
+        self.dropped = 0
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._publisher = None
+        self._subscriber = None
+        self._lock = Lock()
+
+    def publish(self, kind, event, ref):
+        if self._publisher is None:
+            self._start_publisher()
+        try:
+            self._pending.put_nowait(event_record(kind, event, ref))
+        except queue.Full:
+            # a live view may lose events, the webhook must not wait
+            self.dropped += 1
+
+    def _start_publisher(self):
+        with self._lock:
+            if self._publisher is None:
+                self._publisher = Thread(target=self._publish_loop, name='live-feed-publisher')
+                self._publisher.daemon = True
+                self._publisher.start()
+
+    def _publish_loop(self):
+        while True:
+            records = [self._pending.get()]
+            while len(records) < 500:
+                try:
+                    records.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                for record in records:
+                    pipe.publish(self.channel, json.dumps(record))
+                pipe.execute()
+            except Exception:
+                self.dropped += len(records)
+                logger.exception('live feed publish failed')
+                time.sleep(1)
+
+    def start(self):
+        """
+        Subscribe this process to the channel
+        :return: None
+        """
+        with self._lock:
+            if self._subscriber is not None:
+                return
+            self._subscriber = Thread(target=self._subscribe_loop, name='live-feed-subscriber')
+            self._subscriber.daemon = True
+            self._subscriber.start()
+
+    def _subscribe_loop(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    self.deliver(json.loads(message['data']))
+            except Exception:
+                logger.exception('live feed subscription failed, resubscribing')
+                time.sleep(1)
+
+
+def create_live_feed(backend, size=1000, window=60, redis_url=None, channel='mg:live'):
+    """
+    Build the live feed for a backend
+    :param backend: 'memory', 'redis' or None to disable
+    :param size: ring buffer size
+    :param window: seconds of per second counters
+    :param redis_url:
+    :param channel: the redis pub/sub channel
+    :return: LiveFeed or None
+    """
+    if not backend:
+        return None
+
+    if backend == 'memory':
+        return LiveFeed(size, window)
+
+    if backend == 'redis':
+        import redis
+        return RedisLiveFeed(redis.StrictRedis.from_url(redis_url), channel, size, window)
+
+    raise ValueError('Unknown live feed backend: {}'.format(backend))
+
+
+def iter_sse(feed, company_id, last_event_id=None, duration=300, tick=1.0):
+    """
+    A company's Server-Sent Events stream: every new event as a 'webhook'
+    event, and the per second counters as a 'counters' event every tick.
+    Ends after duration seconds, the browser's EventSource reconnects with
+    Last-Event-ID.
+    :param feed: LiveFeed
+    :param company_id:
+    :param last_event_id: Last-Event-ID, None to start with what is buffered
+    :param duration: seconds
+    :param tick: seconds between counter updates
+    :return: generator of str
+    """
+    last_seq = feed.last_seq(last_event_id)
+    deadline = time.time() + duration
+    next_tick = 0
+    yield 'retry: 2000\n\n'
+
+    while time.time() < deadline:
+        for seq, record in feed.events.wait(last_seq, tick):
+            last_seq = seq
+            if record['company_id'] == company_id:
+                yield 'id: {}\nevent: webhook\ndata: {}\n\n'.format(feed.event_id(seq), json.dumps(record))
+
+        now = time.time()
+        if now >= next_tick:
+            next_tick = now + tick
+            counters = feed.counters.company(company_id)
+            yield 'id: {}\nevent: counters\ndata: {}\n\n'.format(feed.event_id(last_seq), json.dumps(counters))
@@ -0,0 +1,120 @@
+from flask_mail import Mail, Message, BadHeaderError
+import config
+import logging
+import smtplib
+
+logger = logging.getLogger(__name__)
+
+# unbound, create_app() and the mail tasks each bind it to their own app
+mail = Mail()
+
+
+def init_mail(flask_app):
+    """
+    Configure Flask-Mail on a Flask app
+    :param flask_app:
+    :return: None
+    """
+    flask_app.config['MAIL_SERVER'] = config.MAIL_SERVER
+    flask_app.config['MAIL_PORT'] = config.MAIL_PORT
+    flask_app.config['MAIL_USE_TLS'] = config.MAIL_USE_TLS
+    flask_app.config['MAIL_USERNAME'] = config.MAIL_USERNAME
+    flask_app.config['MAIL_PASSWORD'] = config.MAIL_PASSWORD
+    flask_app.config['MAIL_DEFAULT_SENDER'] = config.MAIL_DEFAULT_SENDER
+    mail.init_app(flask_app)
+
+
+def email_payload(to, subject, html, text='', **extra):
+    """
+    The JSON payload of one outbound email, see send_email_batch
+    :param to: recipient address
+    :param subject:
+    :param html: html body
+    :param text: plain text body
+    :param extra: eg. lead_id, sender
+    :return: dict
+    """
+    payload = {"to": to, "subject": subject, "html": html}
+    if text:
+        payload['text'] = text
+    payload.update(extra)
+    return payload
+
+
+def recipient_domain(payload):
+    return payload['to'].rpartition('@')[2].strip().lower()
+
+
+def build_message(payload):
+    """
+    A Flask-Mail Message for a payload, in an app context
+    :param payload: dict from email_payload()
+    :return: Message
+    """
+    return Message(
+        payload['subject'],
+        sender=payload.get('sender') or config.MAIL_DEFAULT_SENDER,
+        recipients=[payload['to']],
+        body=payload.get('text', ''),
+        html=payload.get('html')
+    )
+
+
+def _transient(code):
+    # 4xx replies are temporary, anything else will not get better
+    return 400 <= code < 500
+
+
+def send_batch(payloads, limiter=None):
+    """
+    Send a batch of payloads, grouped by recipient domain, over one SMTP
+    connection per group of up to MAIL_MESSAGES_PER_CONNECTION messages.
+    A refused message only fails itself; a dropped connection leaves the
+    rest of its group for a retry.  Call in an app context.
+    :param payloads: list of dict from email_payload()
+    :param limiter: ratelimit.DomainRateLimiter
+    :return: (sent, retry, failed) lists of payloads, sent ones carry the message_id
+    """
+    groups = {}
+    for payload in payloads:
+        groups.setdefault(recipient_domain(payload), []).append(payload)
+
+    sent = []
+    retry = []
+    failed = []
+    size = config.MAIL_MESSAGES_PER_CONNECTION
+
+    for domain, group in sorted(groups.items()):
+        for start in range(0, len(group), size):
+            pending = group[start:start + size]
+
+            try:
+                with mail.connect() as connection:
+                    while pending:
+                        payload = pending[0]
+                        if limiter is not None:
+                            limiter.wait(domain)
+
+                        try:
+                            message = build_message(payload)
+                            connection.send(message)
+                            sent.append(dict(payload, message_id=message.msgId))
+
+                        except smtplib.SMTPRecipientsRefused as err:
+                            codes = [code for code, _ in err.recipients.values()]
+                            (retry if all(_transient(code) for code in codes) else failed).append(payload)
+
+                        except smtplib.SMTPResponseException as err:
+                            (retry if _transient(err.smtp_code) else failed).append(payload)
+
+                        except (BadHeaderError, AssertionError):
+                            failed.append(payload)
+
+                        pending.pop(0)
+
+            # connection level failure, whatever was not sent goes again
+            except (smtplib.SMTPException, OSError) as err:
+                logger.warning('SMTP connection for %s failed: %s', domain, err)
+                retry.extend(pending)
+
+    return sent, retry, failed
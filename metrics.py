@@ -0,0 +1,279 @@
+from bisect import bisect_left
+from threading import Lock
+import config
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# latency buckets in seconds, 0.5ms to 10s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """
+    Base for the metric types.  Samples are kept per label values tuple;
+    nothing is formatted until a scrape calls ``render``.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} {}'.format(self.name, self.kind)
+        ]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing count
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labelnames=()):
+        super(Counter, self).__init__(name, description, labelnames)
+        self._values = {}
+
+    def inc(self, labels=(), amount=1):
+        """
+        Add to the counter
+        :param labels: tuple of label values
+        :param amount:
+        :return: None
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{}{} {}'.format(self.name, _labels(self.labelnames, labels), _number(value))
+                for labels, value in values]
+
+
+class Histogram(Metric):
+    """
+    A latency histogram with fixed buckets
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, description, labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, labels, value):
+        """
+        Record one observation.  Only the bucket it falls into is counted
+        here, the cumulative counts are summed at scrape time.
+        :param labels: tuple of label values
+        :param value: seconds
+        :return: None
+        """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def _samples(self):
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+
+        lines = []
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _labels(self.labelnames, labels, 'le="{}"'.format(_number(bound))),
+                    cumulative
+                ))
+            lines.append('{}_sum{} {}'.format(self.name, _labels(self.labelnames, labels), repr(total)))
+            lines.append('{}_count{} {}'.format(self.name, _labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+class Gauge(Metric):
+    """
+    A gauge read from a callback at scrape time, so it costs nothing
+    between scrapes.  The callback returns a number, or a dict of label
+    values tuple -> number.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, callback, labelnames=()):
+        super(Gauge, self).__init__(name, description, labelnames)
+        self.callback = callback
+
+    def _samples(self):
+        try:
+            values = self.callback()
+        except Exception:
+            logger.exception('gauge %s failed', self.name)
+            return []
+
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        return ['{}{} {}'.format(self.name, _labels(self.labelnames, labels), _number(value))
+                for labels, value in sorted(values.items())]
+
+
+class Registry(object):
+    """
+    The metrics exposed on /metrics.  Set ``enabled`` to False to skip
+    recording on the hot path altogether.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labelnames=()):
+        return self.register(Counter(name, description, labelnames))
+
+    def histogram(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, description, labelnames, buckets))
+
+    def gauge(self, name, description, callback, labelnames=()):
+        return self.register(Gauge(name, description, callback, labelnames))
+
+    def render(self):
+        """
+        Everything registered in the Prometheus text exposition format
+        :return: str
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+registry.enabled = config.METRICS_ENABLED
+
+# webhook hot path
+stage_seconds = registry.histogram(
+    'webhook_stage_seconds',
+    'Time spent in each webhook handler stage',
+    ('stage', 'event')
+)
+request_seconds = registry.histogram(
+    'webhook_request_seconds',
+    'Webhook handling time by event type and response status',
+    ('event', 'status')
+)
+requests_total = registry.counter(
+    'webhook_requests_total',
+    'Webhooks handled by event type and response status',
+    ('event', 'status')
+)
+batch_events_total = registry.counter(
+    'webhook_batch_events_total',
+    'Events in JSON webhook bodies by outcome',
+    ('outcome',)
+)
+shed_total = registry.counter(
+    'webhook_shed_total',
+    'Webhooks answered 503 by the load shedder, by class and reason',
+    ('class', 'reason')
+)
+
+
+def stage_done(stage, kind, start):
+    """
+    Record a handler stage that began at start
+    :param stage: eg. 'verify'
+    :param kind: the event kind
+    :param start: time.perf_counter() when the stage began
+    :return: now, the start of the next stage
+    """
+    now = time.perf_counter()
+    if registry.enabled:
+        stage_seconds.observe((stage, kind), now - start)
+    return now
+
+
+def webhook_done(kind, status, start):
+    """
+    Record a handled webhook request
+    :param kind: the event kind, 'batch' for JSON bodies
+    :param status: the response status code
+    :param start: time.perf_counter() when the request began
+    :return: None
+    """
+    if registry.enabled:
+        labels = (kind, str(status))
+        request_seconds.observe(labels, time.perf_counter() - start)
+        requests_total.inc(labels)
+
+
+def batch_done(counts, status, start):
+    """
+    Record a handled JSON webhook body
+    :param counts: dict from batch_counts()
+    :param status: the response status code
+    :param start: time.perf_counter() when the request began
+    :return: None
+    """
+    if registry.enabled:
+        webhook_done('batch', status, start)
+        for outcome, count in counts.items():
+            if count:
+                batch_events_total.inc((outcome,), count)
+
+
+def webhook_shed(kind, shed_class, reason, start):
+    """
+    Record a webhook turned away by the load shedder
+    :param kind: the event kind, 'batch' for JSON bodies
+    :param shed_class: the shedding class
+    :param reason: 'inflight' or 'latency'
+    :param start: time.perf_counter() when the request began
+    :return: None
+    """
+    if registry.enabled:
+        webhook_done(kind, 503, start)
+        shed_total.inc((shed_class, reason))
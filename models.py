@@ -1,6 +1,7 @@
 from database import Base
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean
+from sqlalchemy import (Column, Integer, BigInteger, String, ForeignKey, Date, DateTime, Boolean, Index,
+                        UniqueConstraint, DDL, event)
 from sqlalchemy.orm import relationship
 from werkzeug.security import generate_password_hash, check_password_hash
 # Define application Bases
@@ -9,7 +10,7 @@ from werkzeug.security import generate_password_hash, check_password_hash
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
-    company_id = Column(Integer, ForeignKey('company.id'), nullable=False)
+    company_id = Column(Integer, ForeignKey('companies.id'), nullable=False)
     company = relationship("Company")
     first_name = Column(String(64), nullable=False)
     last_name = Column(String(64), nullable=False)
@@ -55,12 +56,16 @@ class User(Base):
 
 class Lead(Base):
     __tablename__ = 'leads'
+    # lead imports upsert on (company_id, email_addr), see leadimport.py
+    __table_args__ = (
+        UniqueConstraint('company_id', 'email_addr', name='uq_leads_company_email'),
+    )
     id = Column(Integer, primary_key=True)
-    company_id = Column(Integer, ForeignKey('company.id'), nullable=False)
+    company_id = Column(Integer, ForeignKey('companies.id'), nullable=False)
     company = relationship("Company")
     create_date = Column(DateTime, onupdate=datetime.now)
     modified_date = Column(DateTime, onupdate=datetime.now)
-    email_addr = Column(String(255), nullable=False)
+    email_addr = Column(String(255), nullable=False, index=True)
     is_verified = Column(Boolean, default=False)
     is_optout = Column(Boolean, default=False)
     is_processed = Column(Boolean, default=False)
@@ -108,6 +113,7 @@ class Company(Base):
     alert_email = Column(String(255), nullable=False)
     reports_email = Column(String(255), nullable=False)
     phone_number = Column(String(20), nullable=False)
+    mailgun_signing_key = Column(String(255), nullable=True)
 
     def __repr__(self):
         return '{}'.format(
@@ -116,3 +122,126 @@ class Company(Base):
 
     def get_id(self):
         return int(self.id)
+
+
+# Mailgun sending domains of each company.  Webhooks resolve their company
+# from the domain field, see tenants.py.
+class CompanyDomain(Base):
+    __tablename__ = 'company_domains'
+    domain = Column(String(255), primary_key=True)
+    company_id = Column(Integer, ForeignKey('companies.id'), nullable=False, index=True)
+    company = relationship("Company")
+
+    def __repr__(self):
+        return '{}'.format(
+            self.domain
+        )
+
+
+# Every message sent to a lead, by Message-Id (without the angle
+# brackets), so webhooks resolve their lead with one primary key lookup.
+# Written by sendlog.record_sends() when a send completes.
+class SendLog(Base):
+    __tablename__ = 'send_log'
+    message_id = Column(String(255), primary_key=True)
+    lead_id = Column(Integer, nullable=False)
+    company_id = Column(Integer, nullable=False)
+    sent_date = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return '{} {}'.format(
+            self.message_id,
+            self.lead_id
+        )
+
+
+# Redis engagement counter flushes already applied to the leads table,
+# written in the same transaction as their increments so a flush whose
+# redis cleanup failed is not applied twice.  See counters.py.
+class EngagementFlush(Base):
+    __tablename__ = 'engagement_flushes'
+    flush_id = Column(String(32), primary_key=True)
+    flushed_date = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return '{}'.format(self.flush_id)
+
+
+# Append only log of the webhook events applied to leads.  Partitioned by
+# day on MySQL (see eventlog.add_partitions); partitioned tables need the
+# partition column in the primary key and allow no foreign keys.
+class LeadEvent(Base):
+    __tablename__ = 'lead_events'
+    __table_args__ = (
+        Index('ix_lead_events_company_date', 'company_id', 'event_date'),
+        # a replayed webhook is logged once, see replay.replay_key()
+        UniqueConstraint('event_key', 'event_date', name='uq_lead_events_key'),
+    )
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    event_date = Column(Date, nullable=False)
+    event_time = Column(DateTime, nullable=False)
+    lead_id = Column(Integer, nullable=False, index=True)
+    company_id = Column(Integer, nullable=False)
+    event = Column(String(20), nullable=False)
+    event_key = Column(String(16))
+    message_id = Column(String(255))
+    ip = Column(String(45))
+    device = Column(String(50))
+    client = Column(String(50))
+    code = Column(String(50))
+    reason = Column(String(255))
+
+    def __repr__(self):
+        return '{} {}'.format(
+            self.lead_id,
+            self.event
+        )
+
+
+event.listen(
+    LeadEvent.__table__,
+    'after_create',
+    DDL(
+        "ALTER TABLE lead_events DROP PRIMARY KEY, ADD PRIMARY KEY (id, event_date)"
+    ).execute_if(dialect='mysql')
+)
+event.listen(
+    LeadEvent.__table__,
+    'after_create',
+    DDL(
+        "ALTER TABLE lead_events PARTITION BY RANGE (TO_DAYS(event_date)) "
+        "(PARTITION pmax VALUES LESS THAN MAXVALUE)"
+    ).execute_if(dialect='mysql')
+)
+
+
+# Engagement rollups, event counts per company per hour and per campaign,
+# kept up to date by rollups.RollupWriter as webhooks are applied.
+class CompanyHourlyStats(Base):
+    __tablename__ = 'company_hourly_stats'
+    company_id = Column(Integer, primary_key=True)
+    hour = Column(DateTime, primary_key=True)
+    event = Column(String(20), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '{} {} {}'.format(
+            self.company_id,
+            self.hour,
+            self.event
+        )
+
+
+class CampaignStats(Base):
+    __tablename__ = 'campaign_stats'
+    company_id = Column(Integer, primary_key=True)
+    campaign = Column(String(255), primary_key=True)
+    event = Column(String(20), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '{} {} {}'.format(
+            self.company_id,
+            self.campaign,
+            self.event
+        )
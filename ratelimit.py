@@ -0,0 +1,80 @@
+from threading import Lock
+import time
+
+
+class TokenBucket(object):
+    """
+    A thread safe token bucket refilled at ``rate`` tokens per second, up
+    to ``burst`` tokens.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens=1):
+        """
+        Take tokens now, going into debt when the bucket is short
+        :param tokens:
+        :return: seconds to wait before using them
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= tokens
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens only if the bucket has them
+        :param tokens:
+        :return: bool
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+
+class DomainRateLimiter(object):
+    """
+    Per recipient domain send rate limits for one process.  Domains not
+    listed in ``rates`` share the ``default`` rate each; a rate of None or
+    0 means unlimited.
+    """
+
+    def __init__(self, default=None, rates=None):
+        self.default = default
+        self.rates = dict(rates or {})
+        self._buckets = {}
+        self._lock = Lock()
+
+    def bucket(self, domain):
+        bucket = self._buckets.get(domain)
+        if bucket is None:
+            rate = self.rates.get(domain, self.default)
+            if not rate:
+                return None
+            with self._lock:
+                bucket = self._buckets.setdefault(domain, TokenBucket(rate))
+        return bucket
+
+    def wait(self, domain):
+        """
+        Block until the next send to the domain is allowed
+        :param domain:
+        :return: seconds waited
+        """
+        bucket = self.bucket(domain)
+        delay = bucket.reserve() if bucket is not None else 0.0
+        if delay:
+            time.sleep(delay)
+        return delay
@@ -0,0 +1,167 @@
+from collections import deque
+from threading import Lock
+import hashlib
+import redis
+import time
+
+
+def replay_key(event):
+    """
+    The dedup key of a webhook event.  JSON webhooks carry a unique event
+    id, form webhooks are keyed on token, Message-Id and event name.
+    :param event: dict from EventType.extract()
+    :return: bytes
+    """
+    if event.get('event_id'):
+        raw = 'id:{}'.format(event['event_id'])
+    else:
+        raw = '{}|{}|{}'.format(event.get('token'), event.get('message_id'), event.get('event'))
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=8).digest()
+
+
+def is_stale(event, max_age, now=None):
+    """
+    True when the event's signature timestamp is outside max_age seconds
+    of now, or missing
+    :param event:
+    :param max_age: seconds
+    :param now:
+    :return: bool
+    """
+    try:
+        timestamp = float(event.get('timestamp'))
+    except (TypeError, ValueError):
+        return True
+
+    if now is None:
+        now = time.time()
+    return abs(now - timestamp) > max_age
+
+
+class MemoryReplayCache(object):
+    """
+    Per process replay cache: a ring of hash sets, each covering a slice of
+    the window.  Expired slices are dropped whole, and a slice that fills up
+    early is closed, so memory stays bounded by ``max_entries`` 8 byte keys
+    even when a burst shortens the effective window.
+    """
+
+    def __init__(self, window=3600, slots=12, max_entries=1000000):
+        self.window = window
+        self.slots = slots
+        self.slot_seconds = float(window) / slots
+        self.slot_entries = max(1, max_entries // slots)
+        self.duplicates = 0
+        self._ring = deque()
+        self._lock = Lock()
+
+    def _rotate(self, now):
+        while self._ring and self._ring[0][0] <= now - self.window:
+            self._ring.popleft()
+
+        if (not self._ring or
+                self._ring[-1][0] <= now - self.slot_seconds or
+                len(self._ring[-1][1]) >= self.slot_entries):
+            self._ring.append((now, set()))
+            while len(self._ring) > self.slots:
+                self._ring.popleft()
+
+    def _contains(self, key):
+        for _, keys in self._ring:
+            if key in keys:
+                return True
+        return False
+
+    def seen(self, key):
+        """
+        Has the key been claimed inside the window
+        :param key:
+        :return: bool
+        """
+        with self._lock:
+            self._rotate(time.time())
+            if self._contains(key):
+                self.duplicates += 1
+                return True
+            return False
+
+    def add(self, key):
+        """
+        Claim the key
+        :param key:
+        :return: False when it was already claimed
+        """
+        now = time.time()
+        with self._lock:
+            self._rotate(now)
+            if self._contains(key):
+                self.duplicates += 1
+                return False
+            self._ring[-1][1].add(key)
+            return True
+
+    def discard(self, key):
+        """
+        Release a claimed key, eg. when applying the event failed and
+        mailgun should be allowed to retry it
+        :param key:
+        :return: None
+        """
+        with self._lock:
+            for _, keys in self._ring:
+                keys.discard(key)
+
+    def __len__(self):
+        return sum(len(keys) for _, keys in self._ring)
+
+
+class RedisReplayCache(object):
+    """
+    Replay cache shared between processes, one expiring redis key per
+    claimed event.
+    """
+
+    def __init__(self, client, window=3600, prefix='mg:replay'):
+        self.client = client
+        self.window = window
+        self.prefix = prefix
+        self.duplicates = 0
+
+    def _key(self, key):
+        return '{}:{}'.format(self.prefix, key.hex())
+
+    def seen(self, key):
+        if self.client.exists(self._key(key)):
+            self.duplicates += 1
+            return True
+        return False
+
+    def add(self, key):
+        if self.client.set(self._key(key), 1, ex=self.window, nx=True):
+            return True
+        self.duplicates += 1
+        return False
+
+    def discard(self, key):
+        self.client.delete(self._key(key))
+
+
+def create_replay_cache(backend, window, max_entries=1000000, redis_url=None):
+    """
+    Build the replay cache for a backend
+    :param backend: 'memory', 'redis' or None to disable
+    :param window: seconds
+    :param max_entries: memory backend bound
+    :param redis_url:
+    :return: replay cache or None
+    """
+    if not backend:
+        return None
+
+    if backend == 'memory':
+        return MemoryReplayCache(window=window, max_entries=max_entries)
+
+    if backend == 'redis':
+        return RedisReplayCache(redis.StrictRedis.from_url(redis_url), window=window)
+
+    raise ValueError('Unknown replay cache backend: {}'.format(backend))
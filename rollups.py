@@ -0,0 +1,197 @@
+from datetime import datetime, timedelta
+from sqlalchemy import and_
+from sqlalchemy.dialects import mysql
+from models import CompanyHourlyStats, CampaignStats
+from writebehind import BufferedWriter
+from eventlog import event_time
+
+# the events every rollup reports, in display order
+ROLLUP_EVENTS = ('delivered', 'dropped', 'bounce', 'spam-complaint', 'unsubscribe', 'open', 'click')
+
+
+class RollupWriter(BufferedWriter):
+    """
+    Keeps the engagement rollups up to date.  Counts are summed in memory
+    per (company, hour, event) and (company, campaign, event) and written
+    as upsert increments, so a burst for one company costs one row write
+    per flush instead of one per webhook.
+    """
+
+    name = 'engagement-rollups'
+
+    def __init__(self, session_factory, flush_interval=1.0, max_events=5000):
+        super(RollupWriter, self).__init__(session_factory, flush_interval, max_events)
+        self._hourly = {}
+        self._campaigns = {}
+
+    def add(self, kind, event, lead):
+        """
+        Count an applied webhook event
+        :param kind: the event kind
+        :param event: dict from EventType.extract()
+        :param lead: LeadRef
+        :return: None
+        """
+        hour = event_time(event).replace(minute=0, second=0, microsecond=0)
+        hourly_key = (lead.company_id, hour, kind)
+        campaign = event.get('campaign')
+
+        with self._lock:
+            self._hourly[hourly_key] = self._hourly.get(hourly_key, 0) + 1
+            if campaign:
+                campaign_key = (lead.company_id, campaign[:255], kind)
+                self._campaigns[campaign_key] = self._campaigns.get(campaign_key, 0) + 1
+            pending = self._added()
+
+        self._notify(pending)
+
+    def _take(self):
+        hourly, self._hourly = self._hourly, {}
+        campaigns, self._campaigns = self._campaigns, {}
+        return (hourly, campaigns) if hourly else None
+
+    def _write(self, session, taken):
+        hourly, campaigns = taken
+        upsert_counts(session, CompanyHourlyStats.__table__, ('company_id', 'hour', 'event'), hourly)
+        upsert_counts(session, CampaignStats.__table__, ('company_id', 'campaign', 'event'), campaigns)
+        return len(hourly) + len(campaigns)
+
+    def _split(self, taken):
+        hourly, campaigns = taken
+        return ([({key: count}, {}) for key, count in hourly.items()] +
+                [({}, {key: count}) for key, count in campaigns.items()])
+
+    def _requeue(self, taken):
+        hourly, campaigns = taken
+        for pending, counts in ((self._hourly, hourly), (self._campaigns, campaigns)):
+            for key, count in counts.items():
+                pending[key] = pending.get(key, 0) + count
+        self._pending += len(hourly)
+
+
+def upsert_counts(session, table, key_columns, counts):
+    """
+    Add counts to a rollup table.  MySQL gets a single multi-row
+    INSERT ... ON DUPLICATE KEY UPDATE count = count + VALUES(count), other
+    databases an UPDATE falling back to an INSERT per row.
+    :param session: sqlalchemy session
+    :param table: rollup table
+    :param key_columns: the primary key column names
+    :param counts: {key tuple: count}
+    :return: None
+    """
+    if not counts:
+        return
+
+    rows = []
+    for key, count in counts.items():
+        row = dict(zip(key_columns, key))
+        row['count'] = count
+        rows.append(row)
+
+    if session.get_bind().dialect.name == 'mysql':
+        stmt = mysql.insert(table).values(rows)
+        session.execute(stmt.on_duplicate_key_update(count=table.c['count'] + stmt.inserted['count']))
+        return
+
+    for row in rows:
+        match = and_(*[table.c[column] == row[column] for column in key_columns])
+        result = session.execute(
+            table.update().where(match).values(count=table.c['count'] + row['count'])
+        )
+        if not result.rowcount:
+            session.execute(table.insert().values(row))
+
+
+def summarize(counts):
+    """
+    Event counts and rates.  Delivery, drop and bounce rates are taken over
+    all attempted sends, the engagement rates over delivered mail.
+    :param counts: {event: count}
+    :return: dict
+    """
+    counts = dict((event, counts.get(event, 0)) for event in ROLLUP_EVENTS)
+    attempted = counts['delivered'] + counts['dropped'] + counts['bounce']
+    delivered = counts['delivered']
+
+    def rate(count, total):
+        return round(float(count) / total, 4) if total else 0.0
+
+    rates = {
+        "delivered": rate(counts['delivered'], attempted),
+        "dropped": rate(counts['dropped'], attempted),
+        "bounce": rate(counts['bounce'], attempted)
+    }
+    for event in ('spam-complaint', 'unsubscribe', 'open', 'click'):
+        rates[event] = rate(counts[event], delivered)
+
+    return {"counts": counts, "rates": rates}
+
+
+def company_totals(session, company_id, hours=24, now=None):
+    """
+    A company's counts and rates over the last hours
+    :param session:
+    :param company_id:
+    :param hours:
+    :param now:
+    :return: dict
+    """
+    since = (now or datetime.now()).replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+    rows = session.query(CompanyHourlyStats.event, CompanyHourlyStats.count).filter(
+        CompanyHourlyStats.company_id == company_id,
+        CompanyHourlyStats.hour >= since
+    ).all()
+
+    counts = {}
+    for event, count in rows:
+        counts[event] = counts.get(event, 0) + count
+
+    stats = summarize(counts)
+    stats['since'] = since.isoformat()
+    return stats
+
+
+def company_hourly(session, company_id, hours=24, now=None):
+    """
+    A company's counts and rates hour by hour
+    :param session:
+    :param company_id:
+    :param hours:
+    :param now:
+    :return: list of dict, oldest hour first
+    """
+    since = (now or datetime.now()).replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+    rows = session.query(CompanyHourlyStats).filter(
+        CompanyHourlyStats.company_id == company_id,
+        CompanyHourlyStats.hour >= since
+    ).order_by(CompanyHourlyStats.hour).all()
+
+    by_hour = {}
+    for row in rows:
+        by_hour.setdefault(row.hour, {})[row.event] = row.count
+
+    result = []
+    for hour in sorted(by_hour):
+        stats = summarize(by_hour[hour])
+        stats['hour'] = hour.isoformat()
+        result.append(stats)
+    return result
+
+
+def company_campaigns(session, company_id):
+    """
+    A company's counts and rates per campaign
+    :param session:
+    :param company_id:
+    :return: dict keyed by campaign
+    """
+    rows = session.query(CampaignStats).filter(
+        CampaignStats.company_id == company_id
+    ).all()
+
+    by_campaign = {}
+    for row in rows:
+        by_campaign.setdefault(row.campaign, {})[row.event] = row.count
+
+    return dict((campaign, summarize(counts)) for campaign, counts in by_campaign.items())
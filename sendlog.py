@@ -0,0 +1,64 @@
+"""
+Send log, the Message-Id of every message sent to a lead.
+
+Mailgun echoes the Message-Id in every webhook, so a webhook for a message
+we sent resolves to exactly one lead with a primary key lookup on
+send_log, whatever companies share the recipient address.
+"""
+from datetime import datetime, timedelta
+from models import SendLog
+
+
+def message_key(message_id):
+    """
+    The send log key of a Message-Id.  Mailgun form webhooks and SMTP
+    headers carry it in angle brackets, JSON webhooks without.
+    :param message_id: str or None
+    :return: str or None
+    """
+    if not message_id:
+        return None
+    return message_id.strip().strip('<>') or None
+
+
+def record_sends(session, sent, sent_date=None):
+    """
+    Log the sent payloads that belong to a lead, with one bulk INSERT.
+    Does not commit.
+    :param session: sqlalchemy session
+    :param sent: payloads from mailer.send_batch(), carrying the message_id
+    :param sent_date: defaults to now
+    :return: int, the number of rows logged
+    """
+    sent_date = sent_date or datetime.now()
+    rows = [
+        {
+            "message_id": message_key(payload['message_id']),
+            "lead_id": payload['lead_id'],
+            "company_id": payload['company_id'],
+            "sent_date": sent_date
+        }
+        for payload in sent
+        if payload.get('lead_id') and payload.get('company_id') and message_key(payload.get('message_id'))
+    ]
+    if rows:
+        session.bulk_insert_mappings(SendLog, rows)
+    return len(rows)
+
+
+def purge(session, keep_days):
+    """
+    Drop send log rows older than keep_days.  Commits.
+    :param session: sqlalchemy session
+    :param keep_days:
+    :return: int, the number of rows dropped
+    """
+    try:
+        count = session.query(SendLog).filter(
+            SendLog.sent_date < datetime.now() - timedelta(days=keep_days)
+        ).delete(synchronize_session=False)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return count
@@ -0,0 +1,515 @@
+"""
+Local webhook spool for database outages.
+
+A circuit breaker watches the lead apply step.  After DB_BREAKER_FAILURES
+consecutive database errors it opens, and verified webhook events go to an
+append-only spool on local disk instead and are acknowledged to mailgun.
+Every DB_BREAKER_RESET seconds one attempt goes through to probe the
+database.
+
+The spool is a directory of segment files, one active segment per
+process, each record a length, a CRC32 and the JSON of a (kind, event)
+pair.  Appends are fsynced in groups: a writer waits for an fsync that
+covers its record, concurrent writers share it.  SpoolReplayer reads
+segments through mmap and applies them in order with apply_events(),
+SPOOL_REPLAY_BATCH events per transaction, once the database answers
+again, then deletes them.  A torn record at the end of a segment (a crash
+mid-write) ends that segment; past a corrupt record reading resumes at the
+next valid one.  Records the database refuses for any reason but an
+outage are moved to dead-letter.log in the same directory.
+
+Once a process spools, its later events are spooled too so they stay
+behind the earlier ones, until the replayer has drained every segment the
+process closed and only the one being written is left: new events go to
+the database again and the rest of that segment follows on the next pass.
+
+    python spool.py --replay
+"""
+from threading import Event, Lock, Thread
+from sqlalchemy import exc
+import argparse
+import atexit
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+import config
+
+logger = logging.getLogger(__name__)
+
+# record header: payload length, payload crc32
+HEADER = struct.Struct('>II')
+
+# database errors that mean the database is unreachable, not that the
+# event is bad
+UNAVAILABLE_ERRORS = (exc.OperationalError, exc.InterfaceError, exc.DisconnectionError, exc.TimeoutError)
+
+
+class CircuitOpenError(Exception):
+    """
+    The database circuit breaker is open and there is no spool
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Thread safe circuit breaker.  Opens after ``failures`` consecutive
+    failures; once ``reset_timeout`` seconds have passed it lets a single
+    trial call through (half open), which closes it again on success.
+    """
+
+    def __init__(self, failures=5, reset_timeout=30):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.consecutive = 0
+        self.opened_at = None
+        self.trips = 0
+        self._trial = False
+        self._lock = Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        """
+        Whether the protected call may go ahead
+        :return: bool
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.consecutive = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.consecutive += 1
+            if self._trial or (self.opened_at is None and self.consecutive >= self.failures):
+                if self.opened_at is None:
+                    self.trips += 1
+                    logger.warning('database circuit breaker opened')
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+def encode_record(kind, event):
+    payload = json.dumps([kind, event], separators=(',', ':')).encode('utf-8')
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _valid_record(mapped, offset, size):
+    # end offset of a whole record with a matching crc at offset, or None
+    length, crc = HEADER.unpack_from(mapped, offset)
+    start = offset + HEADER.size
+    end = start + length
+    if end > size or zlib.crc32(mapped[start:end]) != crc:
+        return None
+    return end
+
+
+def _resync(mapped, offset, size):
+    # offset of the next valid record after a bad one at offset, or None
+    for candidate in range(offset + 1, size - HEADER.size + 1):
+        if _valid_record(mapped, candidate, size) is not None:
+            return candidate
+    return None
+
+
+def iter_records(path, offset=0):
+    """
+    The records of a segment from offset on, read through mmap.  A record
+    that is cut short or fails its crc is skipped up to the next valid one;
+    with none after it, it is a torn write and ends the segment.
+    :param path: segment file
+    :param offset: byte offset of the first record
+    :return: generator of (end offset, (kind, event))
+    """
+    with open(path, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size <= offset:
+            return
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            while offset + HEADER.size <= size:
+                end = _valid_record(mapped, offset, size)
+                if end is None:
+                    resumed = _resync(mapped, offset, size)
+                    if resumed is None:
+                        break
+                    logger.error('corrupt spool record in %s, skipped bytes %s to %s', path, offset, resumed)
+                    offset = resumed
+                    continue
+                kind, event = json.loads(mapped[offset + HEADER.size:end].decode('utf-8'))
+                yield end, (kind, event)
+                offset = end
+        finally:
+            mapped.close()
+
+
+class Spool(object):
+    """
+    Segmented append-only event spool in ``directory``.  Each process
+    appends to its own segment, locked with flock while it is open, and
+    starts a new one past ``segment_bytes``.
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.appended = 0
+        self.spooling = False
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._written = 0
+        self._synced = 0
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_segment(self):
+        # names sort in creation order across processes
+        name = 'segment-{:017d}-{}.log'.format(int(time.time() * 1000000), os.getpid())
+        self._path = os.path.join(self.directory, name)
+        self._file = open(self._path, 'ab')
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._size = 0
+
+    def _close_segment(self):
+        # call with self._lock held
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = self._written
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+    def append(self, items):
+        """
+        Append (kind, event) pairs and return once they are on disk
+        :param items: list of (kind, event)
+        :return: None
+        """
+        records = b''.join(encode_record(kind, event) for kind, event in items)
+
+        with self._lock:
+            if self._file is None or self._size >= self.segment_bytes:
+                self._close_segment()
+                self._open_segment()
+            self._file.write(records)
+            self._size += len(records)
+            self._written += 1
+            self.appended += len(items)
+            self.spooling = True
+            ticket = self._written
+
+        self._sync(ticket)
+
+    def _sync(self, ticket):
+        # group commit, one fsync covers every append before it; appends
+        # queued behind the fsync are all covered by the next one
+        with self._lock:
+            if self._synced >= ticket or self._file is None:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._synced = self._written
+
+    def roll(self):
+        """
+        Close the active segment so the replayer can take it
+        :return: None
+        """
+        with self._lock:
+            self._close_segment()
+
+    def pending(self):
+        """
+        Whether new events must be spooled to stay in order: this process
+        spooled and the replayer has not caught up with it yet
+        :return: bool
+        """
+        return self.spooling
+
+    def caught_up(self):
+        """
+        Called by the replayer after a pass: once none of the segments this
+        process closed is left, only the one being written, new events go
+        to the database again
+        :return: bool, whether the spool is caught up
+        """
+        suffix = '-{}.log'.format(os.getpid())
+        with self._lock:
+            active = self._path if self._file is not None else None
+            for path in self.segments():
+                if path.endswith(suffix) and path != active:
+                    return False
+            self.spooling = False
+            return True
+
+    @property
+    def dead_letter_path(self):
+        return os.path.join(self.directory, 'dead-letter.log')
+
+    def dead_letter(self, item):
+        """
+        Keep a record replay gave up on, in the segment format, for a
+        look by hand
+        :param item: (kind, event)
+        :return: None
+        """
+        with open(self.dead_letter_path, 'ab') as fh:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            fh.write(encode_record(*item))
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def segments(self):
+        """
+        Segment paths, oldest first
+        :return: list of str
+        """
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.startswith('segment-') and name.endswith('.log')
+        )
+
+
+def _read_position(path):
+    try:
+        with open(path + '.pos') as fh:
+            return int(fh.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def _write_position(path, offset):
+    tmp = path + '.pos.tmp'
+    with open(tmp, 'w') as fh:
+        fh.write(str(offset))
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, path + '.pos')
+
+
+class SpoolReplayer(object):
+    """
+    Background thread draining the spool into the database every
+    ``interval`` seconds while the circuit breaker lets it.  Segments still
+    being written by another process are left alone (flock), so any number
+    of processes can replay the same directory.
+    """
+
+    name = 'spool-replayer'
+
+    def __init__(self, spool, breaker, session_factory, apply_events, batch_size=500, interval=5.0):
+        self.spool = spool
+        self.breaker = breaker
+        self.session_factory = session_factory
+        self.apply_events = apply_events
+        self.batch_size = batch_size
+        self.interval = interval
+        self.replayed = 0
+        self._stopped = Event()
+        self._thread = None
+        self._lock = Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.spool.roll()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.drain()
+            except Exception:
+                logger.exception('%s drain failed', self.name)
+
+    def drain(self):
+        """
+        Replay every segment not being written, oldest first, until none
+        is left.  New events of this process are spooled behind the old
+        ones until a pass has drained all it closed, see Spool.caught_up().
+        Stops at the first database error and leaves the rest for the next
+        run.
+        :return: number of events replayed
+        """
+        replayed = 0
+        if self.breaker.state == 'open':
+            return replayed
+
+        try:
+            while True:
+                # hand our own active segment over first
+                self.spool.roll()
+                segments = self.spool.segments()
+                if not segments:
+                    break
+
+                drained = 0
+                for path in segments:
+                    drained += self._drain_segment(path)
+                replayed += drained
+                self.spool.caught_up()
+
+                # only segments other processes are writing are left
+                if not drained:
+                    break
+
+        except UNAVAILABLE_ERRORS:
+            self.breaker.failure()
+            raise
+
+        finally:
+            self.replayed += replayed
+
+        if replayed:
+            self.breaker.success()
+        return replayed
+
+    def _drain_segment(self, path):
+        try:
+            fh = open(path, 'rb')
+        except FileNotFoundError:
+            return 0
+
+        with fh:
+            try:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # still being written, or another replayer has it
+                return 0
+
+            replayed = 0
+            batch = []
+            for end, item in iter_records(path, _read_position(path)):
+                batch.append((end, item))
+                if len(batch) >= self.batch_size:
+                    replayed += self._apply(path, batch)
+                    batch = []
+
+            if batch:
+                replayed += self._apply(path, batch)
+
+            os.remove(path)
+            if os.path.exists(path + '.pos'):
+                os.remove(path + '.pos')
+            return replayed
+
+    def _apply(self, path, batch):
+        """
+        Apply a batch of records in one transaction and checkpoint past
+        it.  A batch failing for any reason but an outage is retried record
+        by record, and the records that fail on their own go to the dead
+        letter file, so a bad record does not hold up the ones behind it.
+        :param path: the segment
+        :param batch: list of (end offset, (kind, event))
+        :return: number of events replayed
+        """
+        try:
+            self._apply_events([item for _, item in batch])
+        except UNAVAILABLE_ERRORS:
+            raise
+        except Exception:
+            logger.exception('replaying a batch of %s failed, retrying it record by record', path)
+            return self._apply_each(path, batch)
+
+        _write_position(path, batch[-1][0])
+        return len(batch)
+
+    def _apply_each(self, path, batch):
+        replayed = 0
+        for end, item in batch:
+            try:
+                self._apply_events([item])
+                replayed += 1
+            except UNAVAILABLE_ERRORS:
+                raise
+            except Exception:
+                logger.exception('spooled event in %s failed, moved to %s', path, self.spool.dead_letter_path)
+                self.spool.dead_letter(item)
+            _write_position(path, end)
+        return replayed
+
+    def _apply_events(self, items):
+        session = self.session_factory()
+        try:
+            self.apply_events(session, items)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+def create_spool(directory, segment_bytes):
+    """
+    The configured spool, or None when WEBHOOK_SPOOL_DIR is not set
+    :param directory:
+    :param segment_bytes:
+    :return: Spool or None
+    """
+    if not directory:
+        return None
+    return Spool(directory, segment_bytes=segment_bytes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--replay', action='store_true', help='drain the spool into the database now')
+    parser.add_argument('--dir', default=config.WEBHOOK_SPOOL_DIR)
+    args = parser.parse_args()
+
+    from database import db_session
+    import webhooks
+
+    event_spool = Spool(args.dir, segment_bytes=config.SPOOL_SEGMENT_BYTES)
+    segments = event_spool.segments()
+    print('{} segments in {}'.format(len(segments), args.dir))
+
+    if args.replay:
+        replayer = SpoolReplayer(
+            event_spool,
+            CircuitBreaker(),
+            db_session,
+            webhooks.apply_events,
+            batch_size=config.SPOOL_REPLAY_BATCH
+        )
+        print('{} events replayed'.format(replayer.drain()))
+        for writer in (webhooks.write_buffer, webhooks.event_log, webhooks.rollup_writer):
+            if writer is not None:
+                writer.close()
+
+
+if __name__ == '__main__':
+    main()
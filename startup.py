@@ -0,0 +1,20 @@
+import time
+
+# imported first by every entry point (app.py, tasks.py), so this is close
+# to the moment the process started loading our code
+started = time.time()
+_clock = time.perf_counter()
+
+# phase -> seconds since started
+phases = {}
+
+
+def mark(phase):
+    """
+    Record that a startup phase finished, the first time only
+    :param phase: eg. 'import_app', 'create_app', 'engine'
+    :return: seconds since startup
+    """
+    elapsed = round(time.perf_counter() - _clock, 6)
+    phases.setdefault(phase, elapsed)
+    return elapsed
@@ -0,0 +1,194 @@
+"""
+Suppression index, the addresses we must not send to.
+
+Bounces and spam complaints suppress an address for every company,
+unsubscribes and opt-outs only for the lead's company (see
+SUPPRESSION_GLOBAL_COLUMNS and SUPPRESSION_COMPANY_COLUMNS).  The index
+keeps an 8 byte hash per suppressed address (per company and address for
+the company wide ones) in a sorted array, loaded from the leads table
+every SUPPRESSION_RELOAD_INTERVAL seconds, plus the hashes the webhooks
+added since.  A lookup is a set probe and a binary search in C,
+no database round trip.
+"""
+from array import array
+from bisect import bisect_left
+from threading import Lock
+from sqlalchemy import or_
+from database import db_session
+from models import Lead
+import hashlib
+import logging
+import time
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def address_key(email_addr):
+    return (email_addr or '').strip().lower()
+
+
+def global_hash(email_addr):
+    return _hash('*:' + address_key(email_addr))
+
+
+def company_hash(company_id, email_addr):
+    return _hash('{}:{}'.format(company_id, address_key(email_addr)))
+
+
+class SuppressionIndex(object):
+    """
+    Compact, thread safe set of suppressed addresses.  Reloads swap in a
+    new sorted array; lookups never take the lock.
+    """
+
+    def __init__(self, reload_interval=600):
+        self.reload_interval = reload_interval
+        self.loaded_at = None
+        self._hashes = array('Q')
+        # hash -> when a webhook added it
+        self._added = {}
+        self._lock = Lock()
+        self._reloading = Lock()
+
+    def _contains(self, value):
+        if value in self._added:
+            return True
+        hashes = self._hashes
+        i = bisect_left(hashes, value)
+        return i < len(hashes) and hashes[i] == value
+
+    def load(self, session):
+        """
+        Rebuild the index from the leads table, streaming the flagged leads
+        :param session: sqlalchemy session
+        :return: int, the number of hashes loaded
+        """
+        global_columns = [Lead.__table__.c[column] for column in config.SUPPRESSION_GLOBAL_COLUMNS]
+        company_columns = [Lead.__table__.c[column] for column in config.SUPPRESSION_COMPANY_COLUMNS]
+        started = time.time()
+        values = set()
+
+        try:
+            rows = session.query(
+                Lead.company_id, Lead.email_addr, *(global_columns + company_columns)
+            ).filter(
+                or_(*[column.is_(True) for column in global_columns + company_columns])
+            ).yield_per(10000)
+
+            split = 2 + len(global_columns)
+            for row in rows:
+                if any(row[2:split]):
+                    values.add(global_hash(row[1]))
+                elif any(row[split:]):
+                    values.add(company_hash(row[0], row[1]))
+        finally:
+            session.close()
+
+        hashes = array('Q', sorted(values))
+        # webhook additions may sit in a write-behind buffer for a while,
+        # only the ones well before this load are surely in the table
+        settled = started - config.SUPPRESSION_SETTLE_SECONDS
+        with self._lock:
+            self._hashes = hashes
+            self._added = dict(
+                (value, added) for value, added in self._added.items() if added >= settled
+            )
+            self.loaded_at = time.time()
+
+        return len(hashes)
+
+    def refresh(self, session):
+        """
+        Load the index when it is missing or older than reload_interval.
+        Only the first load blocks; while one thread reloads, the others
+        keep reading the previous array.
+        :param session: sqlalchemy session
+        :return: None
+        """
+        loaded_at = self.loaded_at
+        if loaded_at is not None and time.time() - loaded_at < self.reload_interval:
+            return
+
+        if loaded_at is None:
+            with self._reloading:
+                if self.loaded_at is None:
+                    self.load(session)
+            return
+
+        if self._reloading.acquire(False):
+            try:
+                self.load(session)
+            except Exception:
+                logger.exception('suppression index reload failed, keeping the old one')
+            finally:
+                self._reloading.release()
+
+    def add(self, company_id, email_addr, everywhere=False):
+        """
+        Suppress an address for a company, or for every company
+        :param company_id:
+        :param email_addr:
+        :param everywhere: suppress for all companies
+        :return: None
+        """
+        value = global_hash(email_addr) if everywhere else company_hash(company_id, email_addr)
+        with self._lock:
+            self._added[value] = time.time()
+
+    def add_changes(self, company_id, email_addr, changes):
+        """
+        Suppress an address when a webhook sets one of the suppression
+        columns on its lead
+        :param company_id:
+        :param email_addr:
+        :param changes: the lead column values the webhook sets
+        :return: None
+        """
+        if not email_addr:
+            return
+        if any(changes.get(column) for column in config.SUPPRESSION_GLOBAL_COLUMNS):
+            self.add(company_id, email_addr, everywhere=True)
+        elif any(changes.get(column) for column in config.SUPPRESSION_COMPANY_COLUMNS):
+            self.add(company_id, email_addr)
+
+    def is_suppressed(self, email_addr, company_id=None):
+        """
+        Whether mail to an address must not go out
+        :param email_addr:
+        :param company_id: the sending company, None checks the global list only
+        :return: bool
+        """
+        if self._contains(global_hash(email_addr)):
+            return True
+        return company_id is not None and self._contains(company_hash(company_id, email_addr))
+
+
+# per process index, loaded on first use
+index = SuppressionIndex(reload_interval=config.SUPPRESSION_RELOAD_INTERVAL)
+
+
+def is_suppressed(email_addr, company_id=None):
+    """
+    Check an address against the suppression index, see SuppressionIndex
+    :param email_addr:
+    :param company_id: the sending company
+    :return: bool
+    """
+    if not config.SUPPRESSION_ENABLED:
+        return False
+    index.refresh(db_session)
+    return index.is_suppressed(email_addr, company_id)
+
+
+def payload_suppressed(payload):
+    """
+    Whether an email payload goes to a suppressed address
+    :param payload: dict from mailer.email_payload()
+    :return: bool
+    """
+    return is_suppressed(payload['to'], payload.get('company_id'))
@@ -0,0 +1,230 @@
+import startup
+from celery import Celery
+from sqlalchemy import exc
+from database import db_session
+import database
+import eventlog
+import followups
+import logging
+import ratelimit
+import sendlog
+import spool
+import suppression
+import webhooks
+import config
+
+# Celery app.  Workers run `celery -A tasks.celery worker` and never import
+# Flask or the web routes; the task names keep the app. prefix they had
+# when the tasks lived in app.py, so queued messages still route.
+celery = Celery('app', broker=config.CELERY_BROKER_URL, backend=config.CELERY_RESULT_BACKEND)
+celery.conf.update(accept_content=config.CELERY_ACCEPT_CONTENT)
+celery.conf.beat_schedule = {
+    'flush-engagement-counters': {
+        'task': 'app.flush_engagement_counters',
+        'schedule': config.ENGAGEMENT_FLUSH_INTERVAL
+    },
+    'maintain-event-log-partitions': {
+        'task': 'app.maintain_event_log_partitions',
+        'schedule': 6 * 60 * 60
+    },
+    'purge-send-log': {
+        'task': 'app.purge_send_log',
+        'schedule': 24 * 60 * 60
+    }
+}
+if config.FOLLOWUP_DISPATCH_INTERVAL:
+    celery.conf.beat_schedule['dispatch-followups'] = {
+        'task': 'app.dispatch_followups',
+        'schedule': config.FOLLOWUP_DISPATCH_INTERVAL
+    }
+
+logger = logging.getLogger(__name__)
+
+# per recipient domain send rates, per worker process
+domain_limiter = ratelimit.DomainRateLimiter(config.MAIL_DOMAIN_RATE, config.MAIL_DOMAIN_RATES)
+
+# Flask app carrying only the Flask-Mail settings, built on the first send
+_mail_app = None
+
+
+def mail_app():
+    global _mail_app
+    if _mail_app is None:
+        from flask import Flask
+        import mailer
+
+        flask_app = Flask('app')
+        mailer.init_mail(flask_app)
+        _mail_app = flask_app
+    return _mail_app
+
+
+# tasks sections, for async functions, etc...
+# pickled Flask-Mail messages, kept for messages queued before send_email_batch
+@celery.task(name='app.send_async_email', serializer='pickle')
+def send_async_email(msg):
+    """Background task to send an email with Flask-Mail."""
+    import mailer
+
+    with mail_app().app_context():
+        mailer.mail.send(msg)
+
+
+@celery.task(name='app.send_email_batch', bind=True, serializer='json', ignore_result=True,
+             max_retries=config.MAIL_MAX_RETRIES)
+def send_email_batch(self, payloads):
+    """Background task to send a batch of JSON email payloads, one SMTP connection per recipient domain group."""
+    import mailer
+
+    with mail_app().app_context():
+        sent, retry, failed = mailer.send_batch(payloads, domain_limiter)
+
+    # messages to leads go to the send log for the webhooks
+    try:
+        if sendlog.record_sends(db_session, sent):
+            db_session.commit()
+    except exc.SQLAlchemyError:
+        db_session.rollback()
+        logger.exception('could not log %s sent messages', len(sent))
+    finally:
+        db_session.remove()
+
+    for payload in failed:
+        logger.warning('email to %s refused permanently', payload['to'])
+
+    # retry only the transient failures, backing off with every attempt
+    if retry:
+        raise self.retry(
+            args=(retry,),
+            countdown=config.MAIL_RETRY_DELAY * (self.request.retries + 1)
+        )
+
+
+def queue_emails(payloads):
+    """
+    Queue email payloads as send_email_batch tasks of MAIL_BATCH_SIZE,
+    dropping the ones to suppressed addresses
+    :param payloads: list of dict from mailer.email_payload()
+    :return: list of AsyncResult
+    """
+    size = config.MAIL_BATCH_SIZE
+    payloads = [payload for payload in payloads if not suppression.payload_suppressed(payload)]
+    return [
+        send_email_batch.apply_async(args=(payloads[start:start + size],))
+        for start in range(0, len(payloads), size)
+    ]
+
+
+@celery.task(name='app.dispatch_followups', ignore_result=True)
+def dispatch_followups(company_id=None):
+    """Task to claim the leads due a follow-up email and queue them as send_followup_chunk tasks."""
+    try:
+        stats = followups.dispatch(db_session, send_followup_chunk, company_id)
+    finally:
+        db_session.remove()
+    logger.info('queued %(leads)s follow-ups in %(chunks)s chunks', stats)
+
+
+@celery.task(name='app.send_followup_chunk', bind=True, serializer='json', ignore_result=True,
+             max_retries=config.MAIL_MAX_RETRIES)
+def send_followup_chunk(self, lead_ids):
+    """Background task to send the follow-up emails of a chunk of leads and record the receipts in bulk."""
+    import mailer
+
+    try:
+        payloads, suppressed = followups.chunk_payloads(db_session, lead_ids)
+        with mail_app().app_context():
+            sent, retry, failed = mailer.send_batch(payloads, domain_limiter)
+        followups.record_results(db_session, sent, failed, suppressed)
+    finally:
+        db_session.remove()
+
+    for payload in failed:
+        logger.warning('follow-up to %s refused permanently', payload['to'])
+
+    # transient failures go again as a smaller chunk, given up on they
+    # return to EMAILNOTSENT for the next dispatch
+    retry_ids = [payload['lead_id'] for payload in retry]
+    if retry_ids:
+        if self.request.retries >= self.max_retries:
+            try:
+                followups.release(db_session, retry_ids)
+            finally:
+                db_session.remove()
+            return
+        raise self.retry(
+            args=(retry_ids,),
+            countdown=config.MAIL_RETRY_DELAY * (self.request.retries + 1)
+        )
+
+
+@celery.task(name='app.apply_webhook_event', bind=True, serializer='json', ignore_result=True, max_retries=None)
+def apply_webhook_event(self, kind, event):
+    """Background task to apply a queued webhook event to its lead."""
+    try:
+        webhooks.apply_event(db_session, kind, event)
+    except spool.UNAVAILABLE_ERRORS as err:
+        db_session.rollback()
+        raise self.retry(exc=err, countdown=config.WEBHOOK_RETRY_DELAY)
+    # the database refused the event, trying again will not help
+    except exc.SQLAlchemyError:
+        db_session.rollback()
+        logger.exception('dropping a %s webhook for %s', kind, event.get('recipient'))
+    finally:
+        db_session.remove()
+
+
+@celery.task(name='app.apply_webhook_events', bind=True, serializer='json', ignore_result=True, max_retries=None)
+def apply_webhook_events(self, items):
+    """Background task to apply a queued batch of webhook events in one transaction."""
+    try:
+        webhooks.apply_events(db_session, items)
+    except spool.UNAVAILABLE_ERRORS as err:
+        db_session.rollback()
+        raise self.retry(exc=err, countdown=config.WEBHOOK_RETRY_DELAY)
+    # the database refused an event of the batch, apply them one by one
+    # so only the bad one is dropped
+    except exc.SQLAlchemyError:
+        db_session.rollback()
+        logger.exception('applying a webhook batch failed, splitting it')
+        for kind, event in items:
+            apply_webhook_event.apply_async(args=(kind, event), queue=config.WEBHOOK_QUEUE)
+    finally:
+        db_session.remove()
+
+
+@celery.task(name='app.maintain_event_log_partitions', ignore_result=True)
+def maintain_event_log_partitions():
+    """Periodic task to keep daily lead_events partitions ahead of time and drop expired ones."""
+    engine = database.get_engine()
+    if not config.WEBHOOK_EVENT_LOG or engine.dialect.name != 'mysql':
+        return
+    with engine.begin() as connection:
+        eventlog.add_partitions(connection, days_ahead=config.EVENT_LOG_PARTITION_DAYS)
+        if config.EVENT_LOG_RETENTION_DAYS:
+            eventlog.drop_partitions(connection, keep_days=config.EVENT_LOG_RETENTION_DAYS)
+
+
+@celery.task(name='app.purge_send_log', ignore_result=True)
+def purge_send_log():
+    """Periodic task to drop send log rows older than SEND_LOG_RETENTION_DAYS."""
+    if not config.SEND_LOG_RETENTION_DAYS:
+        return
+    try:
+        sendlog.purge(db_session, config.SEND_LOG_RETENTION_DAYS)
+    finally:
+        db_session.remove()
+
+
+@celery.task(name='app.flush_engagement_counters', ignore_result=True)
+def flush_engagement_counters():
+    """Periodic task to move the redis open/click counters into the leads table."""
+    if webhooks.engagement_counters is None:
+        return
+    try:
+        webhooks.engagement_counters.flush(db_session)
+    finally:
+        db_session.remove()
+
+
+startup.mark('import_tasks')
@@ -0,0 +1,155 @@
+"""
+Tenant resolution, mailgun sending domain -> company.
+
+Every company lists its sending domains in company_domains.  The whole
+mapping, with the companies' own signing keys, is held in process and
+looked up per webhook without a database round trip.  Changes made
+through the ORM in this process, and every TENANT_REFRESH_INTERVAL
+seconds in the others, the mapping is reloaded by a background thread
+while webhooks keep using the old one.  Only the very first load of a
+process, when there is no mapping yet, happens on the request.
+"""
+from threading import Lock, Thread
+from sqlalchemy import event
+from database import db_session
+from models import Company, CompanyDomain
+import logging
+import time
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def domain_key(domain):
+    return (domain or '').strip().lower()
+
+
+class TenantCache(object):
+    """
+    Domain -> company id and company id -> signing key, swapped in whole
+    on every load.  Callbacks registered with on_load() run after each
+    load, eg. to hand the signing keys to the webhook verifier.
+    ``session_factory`` is a scoped session, the reload thread uses and
+    removes its own.
+    """
+
+    RETRY_DELAY = 5
+
+    def __init__(self, session_factory, refresh_interval=60):
+        self.session_factory = session_factory
+        self.refresh_interval = refresh_interval
+        self.domains = {}
+        self.signing_keys = {}
+        self.loaded_at = None
+        self._retry_at = 0
+        self._callbacks = []
+        self._lock = Lock()
+        self._reloading = Lock()
+
+    def on_load(self, callback):
+        self._callbacks.append(callback)
+
+    def load(self, session):
+        """
+        Read the domain mapping and the signing keys
+        :param session: sqlalchemy session, left open
+        :return: None
+        """
+        domains = dict(
+            (domain_key(domain), company_id)
+            for domain, company_id in session.query(CompanyDomain.domain, CompanyDomain.company_id)
+        )
+        signing_keys = dict(session.query(Company.id, Company.mailgun_signing_key).filter(
+            Company.mailgun_signing_key.isnot(None)
+        ))
+
+        self.domains = domains
+        self.signing_keys = signing_keys
+        self.loaded_at = time.time()
+
+        for callback in self._callbacks:
+            callback(self)
+
+    def _try_load(self, session):
+        try:
+            self.load(session)
+        except Exception:
+            self._retry_at = time.time() + self.RETRY_DELAY
+            logger.exception('tenant mapping load failed, keeping the old one')
+
+    def refresh(self, session):
+        """
+        Make sure a mapping is there.  With none loaded yet, load it now
+        with session, one thread at a time; once loaded, a mapping that was
+        invalidated or is older than refresh_interval is reloaded in the
+        background and the old one is used meanwhile.  A failed load is
+        retried after RETRY_DELAY seconds.
+        :param session: sqlalchemy session, used for the first load only
+        :return: None
+        """
+        loaded_at = self.loaded_at
+        if loaded_at is not None and time.time() - loaded_at < self.refresh_interval:
+            return
+        if time.time() < self._retry_at:
+            return
+
+        if loaded_at is None:
+            with self._lock:
+                if self.loaded_at is None and time.time() >= self._retry_at:
+                    self._try_load(session)
+            return
+
+        self.start()
+
+    def start(self):
+        """
+        Reload the mapping in a background thread unless one is at it
+        :return: None
+        """
+        if not self._reloading.acquire(False):
+            return
+        thread = Thread(target=self._reload, name='tenant-reload')
+        thread.daemon = True
+        thread.start()
+
+    def _reload(self):
+        try:
+            self._try_load(self.session_factory())
+        finally:
+            self.session_factory.remove()
+            self._reloading.release()
+
+    def invalidate(self):
+        # stale, not missing: lookups go on with it until the reload is in
+        if self.loaded_at is not None:
+            self.loaded_at = 0
+
+    def company_id(self, domain):
+        return self.domains.get(domain_key(domain))
+
+
+# per process
+tenant_cache = TenantCache(db_session, refresh_interval=config.TENANT_REFRESH_INTERVAL)
+
+
+def company_for_domain(domain):
+    """
+    The company a mailgun sending domain belongs to
+    :param domain: the webhook's domain field
+    :return: company id or None
+    """
+    if not domain:
+        return None
+    tenant_cache.refresh(db_session)
+    return tenant_cache.company_id(domain)
+
+
+# reload after changes made through the ORM in this process
+@event.listens_for(CompanyDomain, 'after_insert')
+@event.listens_for(CompanyDomain, 'after_update')
+@event.listens_for(CompanyDomain, 'after_delete')
+@event.listens_for(Company, 'after_insert')
+@event.listens_for(Company, 'after_update')
+@event.listens_for(Company, 'after_delete')
+def _invalidate_tenants(mapper, connection, target):
+    tenant_cache.invalidate()
@@ -0,0 +1,554 @@
+from datetime import datetime
+from database import db_session
+from models import Lead
+from sqlalchemy.sql.expression import ClauseElement
+from leads import LeadRef, get_event_lead, get_event_ref
+from itertools import islice
+from writebehind import LeadWriteBuffer
+import backpressure
+import codecs
+import config
+import counters
+import eventlog
+import metrics
+import rollups
+import suppression
+import json
+import livestream
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# buffered bulk lead updates, see WEBHOOK_WRITE_BEHIND
+write_buffer = None
+if config.WEBHOOK_WRITE_BEHIND:
+    write_buffer = LeadWriteBuffer(
+        db_session,
+        flush_interval=config.WRITE_BEHIND_FLUSH_MS / 1000.0,
+        max_events=config.WRITE_BEHIND_MAX_EVENTS
+    )
+
+# append only lead_events log, see WEBHOOK_EVENT_LOG
+event_log = None
+if config.WEBHOOK_EVENT_LOG:
+    event_log = eventlog.EventLogWriter(
+        db_session,
+        flush_interval=config.EVENT_LOG_FLUSH_MS / 1000.0,
+        max_events=config.EVENT_LOG_MAX_EVENTS,
+        chunk_size=config.EVENT_LOG_CHUNK_SIZE
+    )
+
+# per company engagement rollups, see ENGAGEMENT_ROLLUPS
+rollup_writer = None
+if config.ENGAGEMENT_ROLLUPS:
+    rollup_writer = rollups.RollupWriter(
+        db_session,
+        flush_interval=config.ROLLUP_FLUSH_MS / 1000.0
+    )
+
+# in memory feed of the live dashboard stream, see LIVE_FEED
+live_feed = livestream.create_live_feed(
+    config.LIVE_FEED,
+    size=config.LIVE_FEED_SIZE,
+    window=config.LIVE_FEED_WINDOW,
+    redis_url=config.LIVE_FEED_REDIS_URL,
+    channel=config.LIVE_FEED_CHANNEL
+)
+
+
+# form fields every mailgun webhook carries, form key -> event key
+COMMON_FIELDS = (
+    ('Message-Id', 'message_id'),
+    ('X-Mailgun-Sid', 'x_mail_gun_sid'),
+    ('domain', 'domain'),
+    ('event', 'event'),
+    ('timestamp', 'timestamp'),
+    ('recipient', 'recipient'),
+    ('signature', 'signature'),
+    ('token', 'token'),
+    ('campaign-id', 'campaign')
+)
+
+# the webhook event table.  For each kind of event:
+#   fields:     extra form fields, form key -> event key
+#   values:     constant Lead column values
+#   columns:    Lead columns copied from the event, column -> event key
+#   increments: Lead counter columns and their deltas
+EVENT_SPECS = {
+    'delivered': {
+        "values": {"followup_email_delivered": 1}
+    },
+    'dropped': {
+        "fields": (('reason', 'reason'), ('code', 'code'), ('description', 'description')),
+        "values": {"followup_email_delivered": 0, "followup_email_dropped": 1},
+        "columns": {
+            "dropped_code": 'code',
+            "dropped_reason": 'reason',
+            "dropped_description": 'description'
+        }
+    },
+    'bounce': {
+        "fields": (('code', 'code'), ('error', 'error')),
+        "values": {"followup_email_delivered": 0, "followup_email_bounced": 1},
+        "columns": {"dropped_code": 'code', "bounce_error": 'error'}
+    },
+    'spam-complaint': {
+        "values": {"followup_email_delivered": 0, "followup_email_spam": 1}
+    },
+    'unsubscribe': {
+        "values": {"followup_email_delivered": 0, "followup_email_unsub": 1}
+    },
+    'click': {
+        "fields": (('ip', 'ip'), ('device-type', 'device_type'), ('client-type', 'client_type')),
+        "values": {"followup_email_delivered": 0},
+        "columns": {"followup_email_click_ip": 'ip', "followup_email_click_device": 'device_type'},
+        "increments": {"followup_email_clicks": 1}
+    },
+    'open': {
+        "fields": (('ip', 'ip'), ('device-type', 'device_type'), ('client-type', 'client_type')),
+        "values": {"followup_email_delivered": 0},
+        "columns": {"followup_email_open_ip": 'ip', "followup_email_open_device": 'device_type'},
+        "increments": {"followup_email_opens": 1}
+    }
+}
+
+# webhook routes -> event kind, None dispatches on the event field
+WEBHOOK_ROUTES = (
+    ('/api/v1/wh/mg/events', None),
+    ('/api/v1/wh/mg/lead/email/delivered', 'delivered'),
+    ('/api/v1/wh/mg/lead/email/dropped', 'dropped'),
+    ('/api/v1/wh/mg/lead/email/bounced', 'bounce'),
+    ('/api/v1/wh/mg/lead/email/spam/complaint', 'spam-complaint'),
+    ('/api/v1/wh/mg/lead/email/unsubscribe', 'unsubscribe'),
+    ('/api/v1/wh/mg/lead/email/click', 'click'),
+    ('/api/v1/wh/mg/lead/email/open', 'open')
+)
+
+# mailgun event names -> event kind
+EVENT_KINDS = {
+    'delivered': 'delivered',
+    'dropped': 'dropped',
+    'bounced': 'bounce',
+    'bounce': 'bounce',
+    'complained': 'spam-complaint',
+    'spam-complaint': 'spam-complaint',
+    'unsubscribed': 'unsubscribe',
+    'unsubscribe': 'unsubscribe',
+    'clicked': 'click',
+    'click': 'click',
+    'opened': 'open',
+    'open': 'open'
+}
+
+
+# mailgun JSON webhooks, event key -> path into the event-data object
+JSON_FIELDS = (
+    ('event_id', ('id',)),
+    ('message_id', ('message', 'headers', 'message-id')),
+    ('event', ('event',)),
+    ('recipient', ('recipient',)),
+    ('reason', ('reason',)),
+    ('code', ('delivery-status', 'code')),
+    ('description', ('delivery-status', 'description')),
+    ('error', ('delivery-status', 'message')),
+    ('ip', ('ip',)),
+    ('device_type', ('client-info', 'device-type')),
+    ('client_type', ('client-info', 'client-type'))
+)
+
+# request bodies handled as JSON webhooks instead of form posts
+JSON_MIMETYPES = ('application/json', 'application/x-ndjson', 'application/jsonlines')
+
+
+class EventType(object):
+    """
+    A compiled entry of the webhook event table.  Holds the field and
+    column pairs as flat tuples so extracting an event and building its
+    Lead changes is a straight loop, with no per request branching.
+    """
+
+    def __init__(self, kind, fields=(), values=None, columns=None, increments=None):
+        self.kind = kind
+        self.fields = COMMON_FIELDS + tuple(fields)
+        self.values = dict(values or {})
+        self.columns = tuple((columns or {}).items())
+        self.increments = dict(increments or {})
+
+    def extract(self, form):
+        """
+        Pull the event out of the webhook form data
+        :param form: request.form or any mapping
+        :return: dict
+        """
+        get = form.get
+        event = {key: get(field) for field, key in self.fields}
+        if not event['event']:
+            event['event'] = self.kind
+        return event
+
+    def changes(self, event):
+        """
+        The Lead column values this event sets
+        :param event: dict from extract()
+        :return: dict
+        """
+        changes = self.values.copy()
+        for column, key in self.columns:
+            changes[column] = event.get(key)
+        return changes
+
+
+EVENT_TYPES = dict(
+    (kind, EventType(kind, **spec)) for kind, spec in EVENT_SPECS.items()
+)
+
+# redis open/click counters, see ENGAGEMENT_COUNTERS_REDIS
+engagement_counters = None
+if config.ENGAGEMENT_COUNTERS_REDIS:
+    engagement_counters = counters.from_url(
+        config.ENGAGEMENT_REDIS_URL,
+        [column for event_type in EVENT_TYPES.values() for column in event_type.increments]
+    )
+
+
+def _dig(data, path):
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+def _object(value, name):
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise ValueError('{} must be a JSON object'.format(name))
+    return value
+
+
+def _string(value, name):
+    if value is not None and not isinstance(value, str):
+        raise ValueError('{} must be a string'.format(name))
+    return value
+
+
+def json_event_kind(data):
+    """
+    The event kind of a JSON event-data object.  Mailgun reports drops and
+    bounces as 'failed' events, temporary failures have no kind.
+    :param data: the event-data object
+    :return: str or None
+    """
+    name = data.get('event')
+    if name == 'failed':
+        if data.get('severity') != 'permanent':
+            return None
+        return 'bounce' if data.get('reason') == 'bounce' else 'dropped'
+    return EVENT_KINDS.get(name)
+
+
+def event_from_json(payload, kind=None):
+    """
+    Normalize a mailgun JSON webhook into the same event dict the form
+    webhooks produce
+    :param payload: the decoded webhook body
+    :param kind: force the event kind, eg. from a per event route
+    :return: (kind or None, dict)
+    :raises ValueError: for a payload not shaped like a mailgun webhook
+    """
+    if not isinstance(payload, dict):
+        raise ValueError('webhook payload must be a JSON object')
+
+    data = _object(payload.get('event-data'), 'event-data')
+    signature = _object(payload.get('signature'), 'signature')
+
+    event = dict((key, _string(_dig(data, path), key)) for key, path in JSON_FIELDS if key != 'code')
+    event['code'] = _text(_dig(data, ('delivery-status', 'code')))
+    event['x_mail_gun_sid'] = None
+    event['token'] = _string(signature.get('token'), 'token')
+    event['signature'] = _string(signature.get('signature'), 'signature')
+
+    timestamp = signature.get('timestamp')
+    if not isinstance(timestamp, (str, int, float, type(None))):
+        raise ValueError('timestamp must be a string or a number')
+    event['timestamp'] = _text(timestamp)
+
+    # the sending domain, from the envelope sender address
+    sender = _string(_dig(data, ('envelope', 'sender')), 'envelope sender') or ''
+    event['domain'] = sender.rpartition('@')[2] or None
+
+    # campaigns are tracked through the first tag
+    tags = data.get('tags') or [None]
+    if not isinstance(tags, list):
+        raise ValueError('tags must be a JSON array')
+    event['campaign'] = _string(tags[0], 'tag')
+
+    if kind is None:
+        kind = json_event_kind(data)
+    if not event['event']:
+        event['event'] = kind
+
+    return kind, event
+
+
+class JSONStreamDecoder(object):
+    """
+    Push parser for webhook bodies holding a single JSON object, a JSON
+    array of objects or newline delimited objects.  Chunks are fed as they
+    arrive and only the unparsed tail is kept.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+
+    def feed(self, chunk, final=False):
+        """
+        Decode a chunk of the body
+        :param chunk: bytes
+        :param final: True for the last chunk
+        :return: list of the documents completed by the chunk
+        """
+        buf = self._buf + self._text.decode(chunk, final=final)
+        pos = 0
+        docs = []
+
+        while True:
+            # skip whitespace plus the array and ndjson separators between objects
+            while pos < len(buf) and buf[pos] in ' \t\r\n,[]':
+                pos += 1
+
+            if pos == len(buf):
+                break
+
+            try:
+                doc, pos = self._decoder.raw_decode(buf, pos)
+            except ValueError:
+                # a document split across reads, unless there is nothing left
+                if final:
+                    raise
+                break
+
+            docs.append(doc)
+
+        self._buf = buf[pos:]
+        return docs
+
+    def close(self):
+        """
+        End of the body
+        :return: list of any documents left
+        """
+        return self.feed(b'', final=True)
+
+
+def iter_json_documents(stream, chunk_size=65536):
+    """
+    Incrementally parse a request body holding a single JSON object, a JSON
+    array of objects or newline delimited objects.  Only the read buffer and
+    the document being decoded are held in memory.
+    :param stream: file like object returning bytes
+    :param chunk_size:
+    :return: generator of decoded documents
+    """
+    decoder = JSONStreamDecoder()
+
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        for doc in decoder.feed(chunk):
+            yield doc
+
+    for doc in decoder.close():
+        yield doc
+
+
+def iter_json_events(stream, kind=None):
+    """
+    Stream (kind, event) pairs out of a JSON webhook body
+    :param stream:
+    :param kind: force the event kind
+    :return: generator
+    """
+    for payload in iter_json_documents(stream):
+        yield event_from_json(payload, kind)
+
+
+def batched(iterable, size):
+    """
+    Split an iterable into lists of at most size items
+    :param iterable:
+    :param size:
+    :return: generator of lists
+    """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+# Lead string column lengths, webhook values are cut to fit
+LEAD_COLUMN_LENGTHS = dict(
+    (column.name, column.type.length) for column in Lead.__table__.columns
+    if isinstance(getattr(column.type, 'length', None), int)
+)
+
+
+def lead_changes(kind, event):
+    """
+    The Lead column values for a webhook event, strings cut to the column
+    length so a long bounce message cannot fail the write
+    :param kind: the event kind, eg. 'delivered'
+    :param event: dict from EventType.extract()
+    :return: dict
+    """
+    changes = EVENT_TYPES[kind].changes(event)
+    for column, value in changes.items():
+        length = LEAD_COLUMN_LENGTHS.get(column)
+        if length and isinstance(value, str) and len(value) > length:
+            changes[column] = value[:length]
+    changes['followup_email_status'] = event.get('event') or kind
+    changes['webhook_last_updated'] = datetime.now()
+    return changes
+
+
+def stage_event(session, kind, event):
+    """
+    Apply a verified webhook event to its lead without committing.  When
+    the write-behind buffer is enabled the changes go there instead.
+    apply_event() and apply_events() log, count and publish the event
+    after the commit, see event_applied().
+    :param session: sqlalchemy session
+    :param kind: the event kind
+    :param event: dict from EventType.extract()
+    :return: LeadRef or None when the recipient is unknown
+    """
+    changes = lead_changes(kind, event)
+    increments = EVENT_TYPES[kind].increments
+    if engagement_counters is not None:
+        # counted in redis after the commit, see event_applied()
+        increments = None
+    start = time.perf_counter()
+
+    if write_buffer is not None:
+        ref = get_event_ref(event)
+        metrics.stage_done('lookup', kind, start)
+        if ref is None:
+            return None
+
+        write_buffer.add(ref.id, changes, increments)
+
+    else:
+        lead = get_event_lead(event)
+        metrics.stage_done('lookup', kind, start)
+        if lead is None:
+            return None
+
+        for column, value in changes.items():
+            setattr(lead, column, value)
+
+        count_engagement(lead, increments)
+        ref = LeadRef(lead.id, lead.company_id)
+
+    return ref
+
+
+def event_applied(kind, event, ref):
+    """
+    Suppress the address of a webhook event when it calls for it, log the
+    event, count it in the rollups and in the redis engagement counters
+    and publish it to the live feed once the transaction applying it to
+    its lead has committed, so a failed commit neither suppresses nor
+    counts, and its retry logs, counts and shows it once.  The lead is
+    stored by then: a side effect that fails (redis down) is logged and
+    the others still run.
+    :param kind: the event kind
+    :param event: dict from EventType.extract()
+    :param ref: LeadRef from stage_event()
+    :return: None
+    """
+    increments = EVENT_TYPES[kind].increments
+    effects = [
+        # later sends skip bounced, complaining and unsubscribed addresses
+        (suppression.index.add_changes, (ref.company_id, event.get('recipient'), EVENT_TYPES[kind].changes(event)))
+    ]
+
+    if increments and engagement_counters is not None:
+        effects.extend((engagement_counters.incr, (ref.id, column, delta)) for column, delta in increments.items())
+
+    if event_log is not None:
+        effects.append((event_log.add, (eventlog.event_row(kind, event, ref),)))
+
+    if rollup_writer is not None:
+        effects.append((rollup_writer.add, (kind, event, ref)))
+
+    if live_feed is not None:
+        effects.append((live_feed.publish, (kind, event, ref)))
+
+    for effect, args in effects:
+        try:
+            effect(*args)
+        except Exception:
+            logger.exception('%s of an applied %s webhook failed', effect.__qualname__, kind)
+
+
+def apply_event(session, kind, event):
+    """
+    Apply a verified webhook event to its lead and commit, or hand it to
+    the write-behind buffer when it is enabled
+    :param session: sqlalchemy session
+    :param kind: the event kind
+    :param event: dict from EventType.extract()
+    :return: lead id or None when the recipient is unknown
+    """
+    ref = stage_event(session, kind, event)
+    if ref is None:
+        return None
+
+    start = time.perf_counter()
+    session.commit()
+    backpressure.observe(metrics.stage_done('commit', kind, start) - start)
+    event_applied(kind, event, ref)
+    return ref.id
+
+
+def apply_events(session, items):
+    """
+    Apply a batch of verified webhook events in a single transaction
+    :param session: sqlalchemy session
+    :param items: (kind, event) pairs
+    :return: list of lead ids, None for unknown recipients
+    """
+    refs = [stage_event(session, kind, event) for kind, event in items]
+    start = time.perf_counter()
+    session.commit()
+    backpressure.observe(metrics.stage_done('commit', 'batch', start) - start)
+
+    for (kind, event), ref in zip(items, refs):
+        if ref is not None:
+            event_applied(kind, event, ref)
+    return [ref.id if ref else None for ref in refs]
+
+
+def count_engagement(lead, increments):
+    """
+    Count opens/clicks for a lead with a server side increment on the lead
+    that is written with the next commit
+    :param lead: Lead
+    :param increments: dict of counter column deltas
+    :return: None
+    """
+    for column, delta in (increments or {}).items():
+        # stack on an increment already pending in this transaction
+        pending = lead.__dict__.get(column)
+        base = pending if isinstance(pending, ClauseElement) else getattr(Lead, column)
+        setattr(lead, column, base + delta)
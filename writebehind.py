@@ -0,0 +1,223 @@
+from threading import Event, Lock, Thread
+from models import Lead
+from leads import increment_columns
+from spool import UNAVAILABLE_ERRORS
+import atexit
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedWriter(object):
+    """
+    Base for the write-behind buffers.  A background thread flushes every
+    ``flush_interval`` seconds, or sooner once ``max_events`` events are
+    pending, and anything left is flushed at interpreter exit.  Subclasses
+    keep the buffered state and implement ``_take``, ``_write``,
+    ``_requeue`` and ``_split``.
+
+    A flush failing because the database is unreachable is put back for
+    the next one.  Any other failure is a row the database refuses: the
+    flush is retried row by row and the refused rows are logged and
+    dropped, so one bad row does not hold up the rest.
+    """
+
+    name = 'write-behind'
+
+    def __init__(self, session_factory, flush_interval=0.5, max_events=1000):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.events = 0
+        self.flushes = 0
+        self._pending = 0
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._thread = None
+
+    def _added(self):
+        # call with self._lock held after buffering one event
+        self.events += 1
+        self._pending += 1
+        return self._pending
+
+    def _notify(self, pending):
+        if self._thread is None:
+            self.start()
+
+        if pending >= self.max_events:
+            self._wakeup.set()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        """
+        Stop the flush thread and write out anything still buffered
+        :return: None
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('%s flush failed', self.name)
+
+    def flush(self):
+        """
+        Write everything buffered in one transaction
+        :return: number of rows written
+        """
+        with self._flush_lock:
+            with self._lock:
+                taken = self._take()
+                self._pending = 0
+
+            if not taken:
+                return 0
+
+            session = self.session_factory()
+            try:
+                written = self._write(session, taken)
+                session.commit()
+                self.flushes += 1
+                return written
+
+            except UNAVAILABLE_ERRORS:
+                session.rollback()
+                with self._lock:
+                    self._requeue(taken)
+                raise
+
+            except Exception:
+                session.rollback()
+                logger.exception('%s flush failed, writing it row by row', self.name)
+                return self._write_each(session, self._split(taken))
+
+            finally:
+                session.close()
+
+    def _write_each(self, session, parts):
+        written = 0
+        for i, part in enumerate(parts):
+            try:
+                written += self._write(session, part)
+                session.commit()
+
+            except UNAVAILABLE_ERRORS:
+                session.rollback()
+                with self._lock:
+                    for rest in parts[i:]:
+                        self._requeue(rest)
+                raise
+
+            except Exception:
+                session.rollback()
+                logger.exception('%s dropped a row the database refused: %r', self.name, part)
+
+        self.flushes += 1
+        return written
+
+    def _take(self):
+        raise NotImplementedError
+
+    def _write(self, session, taken):
+        raise NotImplementedError
+
+    def _requeue(self, taken):
+        raise NotImplementedError
+
+    def _split(self, taken):
+        # what _take() returned, as a list of one row takes for _write()
+        raise NotImplementedError
+
+
+class LeadWriteBuffer(BufferedWriter):
+    """
+    Write-behind buffer for webhook lead updates.
+
+    Column changes for the same lead are merged into a single row image
+    and counter increments are summed, then everything is written with one
+    bulk UPDATE per flush.
+    """
+
+    name = 'lead-write-behind'
+
+    def __init__(self, session_factory, flush_interval=0.5, max_events=1000):
+        super(LeadWriteBuffer, self).__init__(session_factory, flush_interval, max_events)
+        self._rows = {}
+        self._increments = {}
+
+    def add(self, lead_id, changes, increments=None):
+        """
+        Buffer the changes for a lead
+        :param lead_id:
+        :param changes: dict of column values
+        :param increments: dict of counter column deltas
+        :return: None
+        """
+        with self._lock:
+            row = self._rows.get(lead_id)
+            if row is None:
+                row = self._rows[lead_id] = {"id": lead_id}
+            row.update(changes)
+
+            if increments:
+                deltas = self._increments.setdefault(lead_id, {})
+                for column, delta in increments.items():
+                    deltas[column] = deltas.get(column, 0) + delta
+
+            pending = self._added()
+
+        self._notify(pending)
+
+    def _take(self):
+        rows, self._rows = self._rows, {}
+        increments, self._increments = self._increments, {}
+        return (rows, increments) if rows else None
+
+    def _write(self, session, taken):
+        rows, increments = taken
+        session.bulk_update_mappings(Lead, list(rows.values()))
+        increment_columns(session, increments)
+        return len(rows)
+
+    def _split(self, taken):
+        rows, increments = taken
+        parts = [({lead_id: row}, {lead_id: increments[lead_id]} if lead_id in increments else {})
+                 for lead_id, row in rows.items()]
+        # increments for leads with no row image buffered
+        parts.extend(({}, {lead_id: deltas}) for lead_id, deltas in increments.items() if lead_id not in rows)
+        return parts
+
+    def _requeue(self, taken):
+        # put a failed flush back underneath anything buffered since
+        rows, increments = taken
+        for lead_id, row in rows.items():
+            newer = self._rows.get(lead_id)
+            if newer is not None:
+                row.update(newer)
+            self._rows[lead_id] = row
+
+        for lead_id, deltas in increments.items():
+            current = self._increments.setdefault(lead_id, {})
+            for column, delta in deltas.items():
+                current[column] = current.get(column, 0) + delta
+
+        self._pending += len(rows)